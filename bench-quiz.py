@@ -0,0 +1,420 @@
+#!/usr/bin/env python3
+"""Offline benchmark for gen-quiz-images.py
+   Runs the whole generator against local stand-ins for the OpenAI images API,
+   Replicate predictions and the Wikimedia On This Day feed, and reports
+   wall time, per-stage time and peak RSS for each scenario.
+
+   python3 bench-quiz.py                          # all scenarios
+   python3 bench-quiz.py -s baseline -s otd-down  # some of them
+   python3 bench-quiz.py --json bench.json --compare last-bench.json
+"""
+
+import os, io, json, base64, zlib, struct, argparse, sys, shutil, signal
+import tempfile, threading, time, subprocess, ast, random
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+GEN  = os.path.join(HERE, "gen-quiz-images.py")
+
+# ─────────────────────────────────────────────────────────────
+# SCENARIOS
+# Latencies are seconds (multiplied by --latency-scale).
+# poll_processing: polls answered "processing" before a prediction succeeds
+# fail_every / rate_limit_every: every Nth prediction fails / poll gets a 429
+# replicate_down: every prediction submit gets a 503
+# throttle_every: every Nth image request (DALL-E or Flux submit) gets a 429 + Retry-After
+# env: extra environment for the generator (e.g. routing settings)
+# warm: run once untimed first, then time a second run on the same dirs;
+#       a list gives that first run's arguments instead
+# ─────────────────────────────────────────────────────────────
+DEFAULTS = {
+    "openai_latency": 2.0, "submit_latency": 0.3, "poll_latency": 0.05,
+    "poll_processing": 2, "download_latency": 0.1,
+    "fail_every": 0, "rate_limit_every": 0, "retry_after": 1, "replicate_down": False,
+    "throttle_every": 0,
+    "otd_latency": 0.3, "otd_down": False, "otd_events": 150,
+    "warm": False, "args": [], "env": {},
+}
+SCENARIOS = {
+    "baseline":       {},
+    "slow-replicate": {"submit_latency": 1.0, "poll_processing": 6, "poll_latency": 0.3},
+    "flaky-replicate": {"fail_every": 5, "rate_limit_every": 4},
+    "otd-down":       {"otd_down": True},
+    "warm-rerun":     {"warm": True},
+    "prerendered":    {"warm": ["--prerender-days", "1"]},
+    "replicate-down": {"replicate_down": True},
+    "hedged":         {"poll_processing": 30, "env": {"REPLICATE_HEDGE_AFTER": "3"}},
+    "throttled":      {"throttle_every": 3},
+    "local-collages": {"env": {"COLLAGE_ENGINE": "local"}},
+    "local-collages-rerun": {"warm": True, "env": {"COLLAGE_ENGINE": "local"}},
+}
+
+# ─────────────────────────────────────────────────────────────
+# FAKE APIs
+# ─────────────────────────────────────────────────────────────
+def make_png():
+    """A 1024×1024 PNG like the real APIs return (tiny fallback without Pillow)."""
+    try:
+        from PIL import Image
+        buf = io.BytesIO()
+        Image.effect_mandelbrot((1024, 1024), (-2, -1.5, 1, 1.5), 100).convert("RGB").save(buf, "PNG")
+        return buf.getvalue()
+    except ImportError:
+        raw = b"".join(b"\x00" + b"".join(bytes((x * 8 % 256, y * 8 % 256, (x + y) % 256)) for x in range(32))
+                       for y in range(32))
+        chunk = lambda t, d: struct.pack(">I", len(d)) + t + d + struct.pack(">I", zlib.crc32(t + d) & 0xffffffff)
+        return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", 32, 32, 8, 2, 0, 0, 0))
+                + chunk(b"IDAT", zlib.compress(raw)) + chunk(b"IEND", b""))
+
+def make_otd_feed(count):
+    """An On This Day payload of roughly the real feed's size and shape."""
+    verbs = ["founded", "crowned", "signed a treaty with", "discovered", "built", "declared war on"]
+    events = []
+    for i in range(count):
+        year = 400 + (i * 37) % 1650
+        pages = [{"title": f"Page_{i}_{p}", "extract": "Lorem ipsum dolor sit amet. " * 15,
+                  "thumbnail": {"source": f"https://upload.example/{i}_{p}.jpg", "width": 320, "height": 240}}
+                 for p in range(3)]
+        events.append({"year": year, "text": f"King {i} {verbs[i % len(verbs)]} the city of Example {i}. More detail.",
+                       "pages": pages})
+    return json.dumps({"events": events}).encode()
+
+class FakeAPI:
+    """One local HTTP server answering all three APIs; reconfigured per scenario."""
+
+    def __init__(self):
+        self.png = make_png()
+        self.png_b64 = json.dumps({"data": [{"b64_json": base64.b64encode(self.png).decode()}]}).encode()
+        self.lock = threading.Lock()
+        self.configure(DEFAULTS, 1.0)
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            def log_message(self, *a):
+                pass
+            def setup(self):
+                super().setup()
+                api.count("connections")
+            def send(self, code, body, ctype="application/json", headers=()):
+                self.send_response(code)
+                self.send_header("Content-Type", ctype)
+                self.send_header("Content-Length", str(len(body)))
+                for k, v in headers:
+                    self.send_header(k, v)
+                self.end_headers()
+                self.wfile.write(body)
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                api.handle_post(self)
+            def do_GET(self):
+                api.handle_get(self)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.base = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def configure(self, scenario, scale):
+        self.cfg = {k: v * scale if k.endswith("_latency") else v for k, v in scenario.items()}
+        self.otd_feed = make_otd_feed(self.cfg["otd_events"])
+        self.predictions, self.counts = {}, {}
+
+    def count(self, key):
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+            return self.counts[key]
+
+    def throttled(self, h):
+        """Answer every Nth image request with a 429, as a rate limiter would."""
+        if not self.cfg["throttle_every"] or self.count("image requests") % self.cfg["throttle_every"]:
+            return False
+        self.count("429s")
+        h.send(429, b'{"detail":"Request was throttled."}', headers=[("Retry-After", str(self.cfg["retry_after"]))])
+        return True
+
+    def handle_post(self, h):
+        if self.throttled(h):
+            return
+        if "/images/generations" in h.path:
+            self.count("openai")
+            time.sleep(self.cfg["openai_latency"])
+            return h.send(200, self.png_b64)
+        if h.path.endswith("/predictions"):
+            n = self.count("submits")
+            time.sleep(self.cfg["submit_latency"])
+            if self.cfg["replicate_down"]:
+                return h.send(503, b'{"detail":"service unavailable"}')
+            pid = f"p{n}"
+            failing = bool(self.cfg["fail_every"]) and n % self.cfg["fail_every"] == 0
+            with self.lock:
+                self.predictions[pid] = {"polls": 0, "failing": failing}
+            return h.send(201, json.dumps(self.prediction(pid, "starting")).encode())
+        if h.path.endswith("/cancel"):
+            self.count("cancels")
+            pid = h.path.rsplit("/", 2)[1]
+            with self.lock:
+                if pid not in self.predictions:
+                    return h.send(404, b"{}")
+                self.predictions[pid]["canceled"] = True
+            return h.send(200, json.dumps(self.prediction(pid, "canceled")).encode())
+        h.send(404, b"{}")
+
+    def handle_get(self, h):
+        if "/predictions/" in h.path:
+            n = self.count("polls")
+            time.sleep(self.cfg["poll_latency"])
+            if self.cfg["rate_limit_every"] and n % self.cfg["rate_limit_every"] == 0:
+                self.count("429s")
+                return h.send(429, b'{"detail":"Request was throttled."}',
+                              headers=[("Retry-After", str(self.cfg["retry_after"]))])
+            pid = h.path.rsplit("/", 1)[1]
+            with self.lock:
+                pred = self.predictions.get(pid)
+                if pred is None:
+                    return h.send(404, b"{}")
+                pred["polls"] += 1
+                done = pred["polls"] > self.cfg["poll_processing"]
+            status = ("failed" if pred["failing"] else "succeeded") if done else "processing"
+            if pred.get("canceled"):
+                status = "canceled"
+            return h.send(200, json.dumps(self.prediction(pid, status)).encode())
+        if h.path.startswith("/out/"):
+            self.count("downloads")
+            time.sleep(self.cfg["download_latency"])
+            return h.send(200, self.png, "image/png")
+        if "/onthisday/" in h.path:
+            self.count("otd")
+            time.sleep(self.cfg["otd_latency"])
+            if self.cfg["otd_down"]:
+                return h.send(503, b'{"error":"service unavailable"}')
+            etag = f'"{zlib.crc32(self.otd_feed):08x}"'
+            if h.headers.get("If-None-Match") == etag:
+                return h.send(304, b"", headers=[("ETag", etag)])
+            return h.send(200, self.otd_feed, headers=[("ETag", etag)])
+        h.send(404, b"{}")
+
+    def prediction(self, pid, status):
+        get = f"{self.base}/v1/predictions/{pid}"
+        pred = {"id": pid, "status": status, "urls": {"get": get, "cancel": f"{get}/cancel"}}
+        if status == "succeeded":
+            pred["output"] = [f"{self.base}/out/{pid}.png"]
+        elif status == "failed":
+            pred["error"] = "simulated failure"
+        return pred
+
+# ─────────────────────────────────────────────────────────────
+# RUNNER
+# ─────────────────────────────────────────────────────────────
+def run_generator(api, workdir, extra_args, timeout, extra_env=None):
+    """Run gen-quiz-images.py once; return wall time, peak RSS (MB) and exit status."""
+    env = dict(os.environ, **(extra_env or {}),
+               OPENAI_API_KEY="bench", REPLICATE_API_TOKEN="bench",
+               OPENAI_API_BASE=api.base, REPLICATE_API_BASE=api.base, WIKIMEDIA_API_BASE=api.base,
+               QUIZ_WEBROOT=os.path.join(workdir, "www"),
+               QUIZ_STATE_DIR=os.path.join(workdir, "state"),
+               IMAGE_CACHE_DIR=os.path.join(workdir, "cache"))
+    os.makedirs(os.path.join(workdir, "www", "images"), exist_ok=True)
+    with open(os.path.join(workdir, "run.log"), "ab") as log:
+        start = time.monotonic()
+        proc = subprocess.Popen([sys.executable, GEN, *extra_args], env=env, stdout=log, stderr=log)
+        killer = threading.Timer(timeout, lambda: os.kill(proc.pid, signal.SIGKILL))
+        killer.start()
+        _, status, usage = os.wait4(proc.pid, 0)   # rusage of just this child
+        killer.cancel()
+        wall = time.monotonic() - start
+    return wall, usage.ru_maxrss / 1024, os.waitstatus_to_exitcode(status)   # ru_maxrss is KiB on Linux
+
+def read_results(workdir):
+    """Stage timings + image job outcomes the generator left in its state dir."""
+    state_dir = os.path.join(workdir, "state")
+    timings, jobs = {}, {}
+    try:
+        with open(os.path.join(state_dir, "build-state.json")) as f:
+            timings = json.load(f).get("timings", {})
+        journal = max(n for n in os.listdir(state_dir) if n.startswith("journal-"))
+        with open(os.path.join(state_dir, journal)) as f:
+            jobs = json.load(f)["jobs"]
+    except (OSError, ValueError):
+        pass
+    done = sum(1 for j in jobs.values() if j.get("status") == "done")
+    return timings, done, len(jobs)
+
+def run_scenario(api, name, overrides, args):
+    scenario = dict(DEFAULTS, **overrides)
+    runs = []
+    for _ in range(args.repeat):
+        workdir = tempfile.mkdtemp(prefix=f"quiz-bench-{name}-")
+        try:
+            if scenario["warm"]:
+                api.configure(scenario, args.latency_scale)
+                warm_args = scenario["warm"] if isinstance(scenario["warm"], list) else scenario["args"]
+                run_generator(api, workdir, warm_args, args.timeout, scenario["env"])
+            api.configure(scenario, args.latency_scale)
+            wall, rss, code = run_generator(api, workdir, scenario["args"], args.timeout, scenario["env"])
+            timings, done, total = read_results(workdir)
+            runs.append({"wall": round(wall, 3), "peak_rss_mb": round(rss, 1), "exit": code,
+                         "images": f"{done}/{total}", "stages": timings, "requests": dict(api.counts)})
+        finally:
+            if args.keep:
+                print(f"   📁 {name}: {workdir}")
+            else:
+                shutil.rmtree(workdir, ignore_errors=True)
+    # Report the median run by wall time
+    return sorted(runs, key=lambda r: r["wall"])[len(runs) // 2]
+
+# ─────────────────────────────────────────────────────────────
+# REPORT
+# ─────────────────────────────────────────────────────────────
+def delta(now, before):
+    if not before:
+        return ""
+    pct = (now - before) / before * 100
+    return f" ({'+' if pct >= 0 else ''}{pct:.0f}%)"
+
+def print_report(results, previous):
+    print(f"\n{'scenario':<17}{'wall':>14}{'peak RSS':>18}{'images':>9}  stages")
+    for name, r in results.items():
+        prev = previous.get(name, {})
+        stages = ", ".join(f"{k} {v:.2f}s" for k, v in r["stages"].items() if k != "total")
+        print(f"{name:<17}{r['wall']:>7.2f}s{delta(r['wall'], prev.get('wall')):<7}"
+              f"{r['peak_rss_mb']:>9.1f} MB{delta(r['peak_rss_mb'], prev.get('peak_rss_mb')):<7}"
+              f"{r['images']:>8}  {stages}")
+        if r["exit"]:
+            print(f"{'':<17}⚠️  generator exited with {r['exit']}")
+        print(f"{'':<17}requests: {', '.join(f'{k} {v}' for k, v in sorted(r['requests'].items())) or 'none'}")
+
+# ─────────────────────────────────────────────────────────────
+# OTD RANKING MICRO-BENCHMARK  (--otd-ranking)
+# Times the generator's select_otd_events against the original
+# implementation on synthetic feeds and checks they pick the same.
+# ─────────────────────────────────────────────────────────────
+def load_from_generator(*names):
+    """Pull top-level functions/constants out of gen-quiz-images.py without running it."""
+    with open(GEN) as f:
+        tree = ast.parse(f.read())
+    defined = lambda node: {t.id for target in node.targets for t in ast.walk(target) if isinstance(t, ast.Name)}
+    body = [node for node in tree.body
+            if isinstance(node, (ast.Import, ast.ImportFrom))
+            or (isinstance(node, ast.FunctionDef) and node.name in names)
+            or (isinstance(node, ast.Assign) and defined(node) & set(names))]
+    namespace = {}
+    exec(compile(ast.Module(body=body, type_ignores=[]), GEN, "exec"), namespace)
+    return namespace
+
+def legacy_select_otd_events(events):
+    """select_otd_events as originally written (reference): a linear scan lowercasing each event
+    once per keyword, dicts for every candidate and `in` checks against the picked list."""
+    # Filter for events 500-2020 with pages/thumbnails
+    interesting = []
+    for evt in events:
+        year = evt.get('year', 0)
+        text = evt.get('text', '')
+        pages = evt.get('pages', [])
+        
+        if 500 <= year <= 2020 and len(pages) > 0:
+            # Score based on visual/historical keywords
+            keywords = ['emperor', 'king', 'queen', 'war', 'battle', 'discovered', 'founded',
+                       'independence', 'revolution', 'treaty', 'expedition', 'crowned',
+                       'built', 'conquest', 'marines', 'landing', 'attack', 'invasion',
+                       'signed', 'declared', 'assassinated', 'born', 'died']
+            score = sum(1 for kw in keywords if kw.lower() in text.lower())
+            interesting.append({
+                'year': year,
+                'text': text,
+                'pages': pages,
+                'score': score
+            })
+    
+    # Sort by score and year (prefer diverse time periods)
+    interesting.sort(key=lambda x: (x['score'], -x['year']), reverse=True)
+    
+    # Select 8 events spread across centuries
+    selected = []
+    used_centuries = set()
+    
+    for evt in interesting:
+        century = evt['year'] // 100
+        if century not in used_centuries or len(selected) >= 4:
+            selected.append(evt)
+            used_centuries.add(century)
+            if len(selected) == 8:
+                break
+    
+    # If we need more, add highest-scoring remaining
+    if len(selected) < 8:
+        for evt in interesting:
+            if evt not in selected:
+                selected.append(evt)
+                if len(selected) == 8:
+                    break
+    
+    return selected[:4], selected[4:8]  # (main, distractors)
+
+def synthetic_events(count, seed=1):
+    """Feed-shaped events with a realistic mix of keywords, years and pages."""
+    rng = random.Random(seed)
+    words = ("the city army river council church people north great new first old ship "
+             "king queen war battle founded treaty crowned born died signed attack").split()
+    return [{"year": rng.randint(1, 2025),
+             "text": " ".join(rng.choice(words) for _ in range(rng.randint(8, 30))).capitalize() + ".",
+             "pages": [{"title": f"Page {i} {p}"} for p in range(rng.randint(0, 3))]}
+            for i in range(count)]
+
+def bench_otd_ranking(sizes, repeat):
+    current = load_from_generator("select_otd_events", "otd_score", "OTD_MIN_YEAR", "OTD_MAX_YEAR",
+                                  "OTD_KEYWORD_WEIGHTS", "OTD_KEYWORDS")["select_otd_events"]
+    print(f"{'events':>8}{'original':>12}{'current':>12}{'speed-up':>10}  same pick")
+    for size in sizes:
+        events = synthetic_events(size)
+        timings = {}
+        for name, fn in (("original", legacy_select_otd_events), ("current", current)):
+            runs = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                picked = fn(events)
+                runs.append(time.perf_counter() - start)
+            timings[name] = (min(runs), picked)
+        same = timings["original"][1] == timings["current"][1]
+        print(f"{size:>8}{timings['original'][0] * 1000:>10.2f}ms{timings['current'][0] * 1000:>10.2f}ms"
+              f"{timings['original'][0] / timings['current'][0]:>9.1f}×  {'✅' if same else '❌'}")
+
+# ─────────────────────────────────────────────────────────────
+# MAIN
+# ─────────────────────────────────────────────────────────────
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark gen-quiz-images.py against local fake APIs.")
+    parser.add_argument("-s", "--scenario", action="append", choices=list(SCENARIOS),
+                        help="scenario to run (repeatable, default all)")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per scenario, the median is reported")
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="multiply all fake API latencies")
+    parser.add_argument("--timeout", type=float, default=600, help="kill a run after this many seconds")
+    parser.add_argument("--json", metavar="PATH", help="write results as JSON")
+    parser.add_argument("--compare", metavar="PATH", help="show changes against an earlier --json file")
+    parser.add_argument("--keep", action="store_true", help="keep each run's temp dir (logs, output)")
+    parser.add_argument("--otd-ranking", nargs="*", type=int, metavar="N",
+                        help="only benchmark OTD ranking on feeds of N events (default 100 1000 10000)")
+    args = parser.parse_args()
+
+    if args.otd_ranking is not None:
+        bench_otd_ranking(args.otd_ranking or [100, 1000, 10000], max(3, args.repeat))
+        sys.exit(0)
+
+    previous = {}
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)["scenarios"]
+
+    api = FakeAPI()
+    print(f"🧪 Fake APIs on {api.base}")
+    results = {}
+    for name in args.scenario or SCENARIOS:
+        print(f"▶️  {name}...", flush=True)
+        results[name] = run_scenario(api, name, SCENARIOS[name], args)
+    print_report(results, previous)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"python": sys.version.split()[0], "latency_scale": args.latency_scale,
+                       "scenarios": results}, f, indent=2)
+        print(f"\n✅ Results written to {args.json}")
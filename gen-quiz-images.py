@@ -4,14 +4,21 @@
    + Collage images in Bosch / Van Gogh style
 """
 
-import os, json, base64, urllib.request, datetime, shutil, random, hashlib
+import os, io, json, base64, gzip, urllib.parse, urllib.error, http.client, ssl, zlib
+import argparse, sys, datetime, email.utils, random, hashlib, threading, time
+import contextlib, cProfile, pstats, sqlite3, re, shutil, heapq, mmap, struct
 
 OPENAI_API_KEY      = os.environ.get("OPENAI_API_KEY", "")
 REPLICATE_API_TOKEN = os.environ.get("REPLICATE_API_TOKEN", "")
-OUT_DIR  = "/var/www/shelldon.monoroc.de/games/ai-news-quiz/images"
-JSON_PATH = "/var/www/shelldon.monoroc.de/games/ai-news-quiz/quiz-data.json"
-WEBROOT  = "/var/www/shelldon.monoroc.de/games/ai-news-quiz"
+WEBROOT  = os.environ.get("QUIZ_WEBROOT", "/var/www/shelldon.monoroc.de/games/ai-news-quiz")
+OUT_DIR  = os.path.join(WEBROOT, "images")
+JSON_PATH = os.path.join(WEBROOT, "quiz-data.json")
 MODEL    = "dall-e-3"
+REPLICATE_MODEL = "black-forest-labs/flux-schnell"
+# API endpoints (overridable so bench-quiz.py can point a run at its local stand-ins)
+OPENAI_API_BASE    = os.environ.get("OPENAI_API_BASE", "https://api.openai.com")
+REPLICATE_API_BASE = os.environ.get("REPLICATE_API_BASE", "https://api.replicate.com")
+WIKIMEDIA_API_BASE = os.environ.get("WIKIMEDIA_API_BASE", "https://api.wikimedia.org")
 
 # ─────────────────────────────────────────────────────────────
 # TODAY'S NEWS  (update daily)
@@ -407,11 +414,729 @@ ART_STYLES = [
      "suffix": "as a 1930s-1950s retro travel poster — bold flat colors, simplified shapes, optimistic sunny atmosphere, art deco typography, vintage graphic design nostalgia"},
 ]
 
+# ─────────────────────────────────────────────────────────────
+# STREAMING, ATOMIC FILE WRITES
+# Images are streamed in chunks into a temp file, fsync'ed and
+# renamed into place, so an existing file is always complete.
+# SHA-256 + byte count are computed on the fly for quiz-data.json.
+# ─────────────────────────────────────────────────────────────
+CHUNK_SIZE = 64 * 1024
+
+def iter_chunks(fileobj, size=CHUNK_SIZE):
+    while True:
+        chunk = fileobj.read(size)
+        if not chunk:
+            return
+        yield chunk
+
+def write_atomic(out_path, chunks):
+    """Write chunks to out_path via temp file + fsync + rename. Returns {"sha256", "bytes"}."""
+    tmp_path = f"{out_path}.part"
+    digest, size = hashlib.sha256(), 0
+    start = time.monotonic()
+    try:
+        with open(tmp_path, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+                digest.update(chunk)
+                size += len(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, out_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    dir_fd = os.open(os.path.dirname(out_path) or ".", os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)   # make the rename itself durable
+    finally:
+        os.close(dir_fd)
+    # includes producing the chunks (download / base64 decode), as they are streamed
+    trace_complete(f"write {os.path.basename(out_path)}", "disk", start, time.monotonic(), bytes=size)
+    return {"sha256": digest.hexdigest(), "bytes": size}
+
+def file_digest(path):
+    """SHA-256 + byte count of an existing file, read in chunks."""
+    digest, size = hashlib.sha256(), 0
+    with open(path, "rb") as f:
+        for chunk in iter_chunks(f):
+            digest.update(chunk)
+            size += len(chunk)
+    return {"sha256": digest.hexdigest(), "bytes": size}
+
+def b64_json_chunks(fileobj, field="b64_json"):
+    """Yield decoded bytes of a base64 string field from a streaming JSON response,
+    without holding the whole document (or the whole image) in memory."""
+    marker = f'"{field}"'.encode()
+    chunks = iter_chunks(fileobj)
+    buf = b""
+    while True:   # skip ahead to the opening quote of the value
+        i = buf.find(marker)
+        if i >= 0:
+            j = buf.find(b'"', i + len(marker))
+            if j >= 0:
+                buf = buf[j + 1:]
+                break
+        else:
+            buf = buf[-len(marker):]
+        chunk = next(chunks, None)
+        if chunk is None:
+            raise ValueError(f"'{field}' missing from response")
+        buf += chunk
+    pending = b""
+    while True:
+        end = buf.find(b'"')
+        data = buf if end < 0 else buf[:end]
+        carry = b""
+        if end < 0 and data.endswith(b"\\"):   # escape split across chunks
+            data, carry = data[:-1], b"\\"
+        pending += data.replace(b"\\/", b"/").replace(b"\\n", b"")
+        cut = len(pending) - len(pending) % 4
+        if cut:
+            yield base64.b64decode(pending[:cut])
+            pending = pending[cut:]
+        if end >= 0:
+            break
+        chunk = next(chunks, None)
+        if chunk is None:
+            raise ValueError(f"truncated '{field}' in response")
+        buf = carry + chunk
+    if pending:
+        yield base64.b64decode(pending)
+
+# ─────────────────────────────────────────────────────────────
+# METRICS  (every outbound HTTP call + every stage)
+# Recorded in memory during the run; at the end a JSON run report
+# and a node_exporter textfile with histograms are written, so
+# Replicate p95, runs overrunning their cron slot and the cost of
+# each stage can be graphed and alerted on.
+# ─────────────────────────────────────────────────────────────
+REPORT_PATH     = os.environ.get("QUIZ_REPORT_PATH", "")     # default: <state dir>/run-report.json
+PROM_TEXTFILE   = os.environ.get("QUIZ_PROM_TEXTFILE", "")   # default: <state dir>/ai_news_quiz.prom
+IMAGE_COST_USD  = {"openai":    float(os.environ.get("OPENAI_IMAGE_COST", "0.04")),
+                   "replicate": float(os.environ.get("REPLICATE_IMAGE_COST", "0.003")),
+                   "replicate-img2img": float(os.environ.get("REPLICATE_IMG2IMG_COST", "0.025"))}
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+POLL_BUCKETS    = (1, 2, 3, 5, 8, 13, 21, 34)
+METRICS         = {"stage": None, "requests": [], "polls": [], "jobs": [], "cache_hits": set(),
+                   "routing": {"hedged": 0, "hedge_wins": 0, "fallbacks": 0, "breaker_trips": {}},
+                   "rate_limits": {}}
+PAID_OUTCOMES   = ("rendered", "hedge-lost")   # a hedge that lost the race was still paid for
+METRICS_LOCK    = threading.Lock()
+
+def record_request(provider, op, seconds, status, bytes_in=0, bytes_out=0, retries=0):
+    """One outbound call; status is the HTTP status or "error" if none came back."""
+    end = time.monotonic()
+    trace_complete(f"{provider} {op}", "http", end - seconds, end, status=str(status),
+                   bytes_in=bytes_in, bytes_out=bytes_out, retries=retries)
+    with METRICS_LOCK:
+        METRICS["requests"].append({"provider": provider, "op": op, "seconds": seconds, "status": str(status),
+                                    "bytes_in": bytes_in, "bytes_out": bytes_out, "retries": retries})
+
+def record_polls(count):
+    """Poll iterations one Replicate prediction needed."""
+    with METRICS_LOCK:
+        METRICS["polls"].append(count)
+
+def record_job(stage, provider, filename, outcome):
+    """Final state of one image: rendered, cached, skipped or failed
+    (or hedge-lost for a second provider's image that arrived too late)."""
+    with METRICS_LOCK:
+        METRICS["jobs"].append({"stage": stage, "provider": provider, "filename": filename, "outcome": outcome})
+
+def record_cache_hit(filename):
+    """An image that came out of the prompt→image cache instead of an API."""
+    with METRICS_LOCK:
+        METRICS["cache_hits"].add(filename)
+
+def was_cache_hit(filename):
+    with METRICS_LOCK:
+        return filename in METRICS["cache_hits"]
+
+def record_routing(event, provider=None):
+    """A hedge fired / won, a fallback after a failure, or a provider's circuit opening."""
+    with METRICS_LOCK:
+        if provider:
+            METRICS["routing"][event][provider] = METRICS["routing"][event].get(provider, 0) + 1
+        else:
+            METRICS["routing"][event] += 1
+
+def record_rate_limit(provider, wait_s=0.0, throttled=0):
+    """Time a request queued for a rate-limit token, or a 429 that was backed off from."""
+    with METRICS_LOCK:
+        stats = METRICS["rate_limits"].setdefault(provider, {"wait_s": 0.0, "throttled": 0})
+        stats["wait_s"] = round(stats["wait_s"] + wait_s, 3)
+        stats["throttled"] += throttled
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))] if values else 0
+
+def prom_histogram(name, help_text, buckets, groups):
+    """Text-format lines for one histogram; groups maps a label string → observed values."""
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+    for labels, values in sorted(groups.items()):
+        for le in (*buckets, "+Inf"):
+            n = len(values) if le == "+Inf" else sum(1 for v in values if v <= le)
+            lines.append(f'{name}_bucket{{{labels}{"," if labels else ""}le="{le}"}} {n}')
+        braces = f"{{{labels}}}" if labels else ""
+        lines += [f"{name}_sum{braces} {sum(values):.4f}", f"{name}_count{braces} {len(values)}"]
+    return lines
+
+def write_run_metrics(day, timings):
+    """Write the JSON run report + Prometheus textfile for this run."""
+    requests, jobs = METRICS["requests"], METRICS["jobs"]
+    by_op = {}
+    for r in requests:
+        by_op.setdefault((r["provider"], r["op"]), []).append(r)
+    cost = {}
+    for j in jobs:
+        if j["outcome"] in PAID_OUTCOMES:
+            cost[j["provider"]] = cost.get(j["provider"], 0) + IMAGE_COST_USD.get(j["provider"], 0)
+
+    stages = {name: {"seconds": seconds, "images": {}, "cost_usd": 0.0}
+              for name, seconds in timings.items() if name != "total"}
+    for j in jobs:
+        stage = stages.setdefault(j["stage"] or "unknown", {"seconds": None, "images": {}, "cost_usd": 0.0})
+        stage["images"][j["outcome"]] = stage["images"].get(j["outcome"], 0) + 1
+        if j["outcome"] in PAID_OUTCOMES:
+            stage["cost_usd"] = round(stage["cost_usd"] + IMAGE_COST_USD.get(j["provider"], 0), 4)
+    outcomes = {}
+    for j in jobs:
+        outcomes[j["outcome"]] = outcomes.get(j["outcome"], 0) + 1
+
+    report = {
+        "date": day,
+        "finished": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "duration_s": timings.get("total"),
+        "stages": stages,
+        "images": outcomes,
+        "cost_usd": {**{p: round(c, 4) for p, c in cost.items()}, "total": round(sum(cost.values()), 4)},
+        "requests": {
+            f"{provider}/{op}": {
+                "count": len(rs),
+                "retries": sum(r["retries"] for r in rs),
+                "p50_s": round(percentile([r["seconds"] for r in rs], 50), 3),
+                "p95_s": round(percentile([r["seconds"] for r in rs], 95), 3),
+                "max_s": round(max(r["seconds"] for r in rs), 3),
+                "bytes_in": sum(r["bytes_in"] for r in rs),
+                "bytes_out": sum(r["bytes_out"] for r in rs),
+                "status": {s: sum(1 for r in rs if r["status"] == s) for s in sorted({r["status"] for r in rs})},
+            }
+            for (provider, op), rs in sorted(by_op.items())
+        },
+        "routing": METRICS["routing"],
+        "rate_limits": METRICS["rate_limits"],
+        "replicate_polls_per_prediction": {
+            "count": len(METRICS["polls"]),
+            "p50": percentile(METRICS["polls"], 50),
+            "p95": percentile(METRICS["polls"], 95),
+            "max": max(METRICS["polls"], default=0),
+        },
+    }
+    report_path = REPORT_PATH or os.path.join(STATE_DIR, "run-report.json")
+    os.makedirs(os.path.dirname(report_path), exist_ok=True)
+    write_json_atomic(report_path, report, indent=2, ensure_ascii=False)
+
+    op_labels = lambda provider, op: f'provider="{provider}",op="{op}"'
+    lines = prom_histogram("quiz_http_request_duration_seconds", "Outbound HTTP request latency.",
+                           LATENCY_BUCKETS, {op_labels(p, o): [r["seconds"] for r in rs]
+                                             for (p, o), rs in by_op.items()})
+    lines += prom_histogram("quiz_replicate_polls_per_prediction", "Poll iterations per Replicate prediction.",
+                            POLL_BUCKETS, {"": METRICS["polls"]} if METRICS["polls"] else {})
+    lines += ["# HELP quiz_http_requests_total Outbound HTTP requests by status.",
+              "# TYPE quiz_http_requests_total counter"]
+    for (p, o), rs in sorted(by_op.items()):
+        for status in sorted({r["status"] for r in rs}):
+            lines.append(f'quiz_http_requests_total{{{op_labels(p, o)},status="{status}"}} '
+                         f'{sum(1 for r in rs if r["status"] == status)}')
+    for metric, field, help_text in (("quiz_http_response_bytes_total", "bytes_in", "Response bytes received."),
+                                     ("quiz_http_request_bytes_total", "bytes_out", "Request bytes sent."),
+                                     ("quiz_http_retries_total", "retries", "Requests retried on a stale connection.")):
+        lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} counter"]
+        lines += [f"{metric}{{{op_labels(p, o)}}} {sum(r[field] for r in rs)}" for (p, o), rs in sorted(by_op.items())]
+    lines += ["# HELP quiz_stage_duration_seconds Wall time of each stage in the last run.",
+              "# TYPE quiz_stage_duration_seconds gauge"]
+    lines += [f'quiz_stage_duration_seconds{{stage="{name}"}} {s["seconds"]}'
+              for name, s in stages.items() if s["seconds"] is not None]
+    lines += ["# HELP quiz_stage_cost_usd Estimated image spend of each stage in the last run.",
+              "# TYPE quiz_stage_cost_usd gauge"]
+    lines += [f'quiz_stage_cost_usd{{stage="{name}"}} {s["cost_usd"]}' for name, s in stages.items()]
+    lines += ["# HELP quiz_images Images of the last run by outcome.", "# TYPE quiz_images gauge"]
+    lines += [f'quiz_images{{outcome="{o}"}} {n}' for o, n in sorted(outcomes.items())]
+    routing = METRICS["routing"]
+    lines += ["# HELP quiz_routing_events Hedged requests, hedge wins and provider fallbacks in the last run.",
+              "# TYPE quiz_routing_events gauge"]
+    lines += [f'quiz_routing_events{{event="{e}"}} {routing[e]}' for e in ("hedged", "hedge_wins", "fallbacks")]
+    lines += ["# HELP quiz_breaker_trips Times a provider's circuit breaker opened in the last run.",
+              "# TYPE quiz_breaker_trips gauge"]
+    lines += [f'quiz_breaker_trips{{provider="{p}"}} {n}' for p, n in sorted(routing["breaker_trips"].items())]
+    lines += ["# HELP quiz_rate_limit_wait_seconds Time requests queued for a rate-limit token in the last run.",
+              "# TYPE quiz_rate_limit_wait_seconds gauge"]
+    lines += [f'quiz_rate_limit_wait_seconds{{provider="{p}"}} {r["wait_s"]}'
+              for p, r in sorted(METRICS["rate_limits"].items())]
+    lines += ["# HELP quiz_rate_limited_responses 429s backed off from and retried in the last run.",
+              "# TYPE quiz_rate_limited_responses gauge"]
+    lines += [f'quiz_rate_limited_responses{{provider="{p}"}} {r["throttled"]}'
+              for p, r in sorted(METRICS["rate_limits"].items())]
+    lines += ["# HELP quiz_run_duration_seconds Wall time of the last run.", "# TYPE quiz_run_duration_seconds gauge",
+              f"quiz_run_duration_seconds {timings.get('total', 0)}",
+              "# HELP quiz_run_last_success_timestamp_seconds When the last run finished.",
+              "# TYPE quiz_run_last_success_timestamp_seconds gauge",
+              f"quiz_run_last_success_timestamp_seconds {int(time.time())}"]
+    prom_path = PROM_TEXTFILE or os.path.join(STATE_DIR, "ai_news_quiz.prom")
+    os.makedirs(os.path.dirname(prom_path), exist_ok=True)
+    write_atomic(prom_path, [("\n".join(lines) + "\n").encode()])   # atomic rename, as node_exporter requires
+    print(f"📈 Run report: {report_path}  ·  metrics: {prom_path}")
+
+# ─────────────────────────────────────────────────────────────
+# PROFILING  (--profile / --profile-cpu)
+# --profile records a trace-event timeline (chrome://tracing or
+# ui.perfetto.dev) with spans for stages, image jobs, HTTP requests,
+# poll waits and disk writes. --profile-cpu adds a cProfile dump of
+# the main thread and the image worker threads (pstats / snakeviz).
+# ─────────────────────────────────────────────────────────────
+TRACE         = None   # list of trace events while profiling, else None
+TRACE_THREADS = {}     # thread id → name, for the timeline's row labels
+TRACE_LOCK    = threading.Lock()
+TRACE_T0      = time.monotonic()
+CPU_PROFILES  = None   # cProfile.Profile per profiled thread, else None
+
+def trace_complete(name, cat, start, end, **trace_args):
+    """Record a finished span (monotonic start/end) on the current thread's row."""
+    if TRACE is None:
+        return
+    thread = threading.current_thread()
+    with TRACE_LOCK:
+        TRACE_THREADS[thread.ident] = thread.name
+        TRACE.append({"name": name, "cat": cat, "ph": "X", "pid": os.getpid(), "tid": thread.ident,
+                      "ts": round((start - TRACE_T0) * 1e6, 1), "dur": round((end - start) * 1e6, 1),
+                      "args": trace_args})
+
+def trace_async(name, cat, start, end, **trace_args):
+    """Record a span on its own track, for work that overlaps on one thread (batched jobs)."""
+    if TRACE is None:
+        return
+    base = {"name": name, "cat": cat, "id": name, "pid": os.getpid(), "tid": threading.get_ident()}
+    with TRACE_LOCK:
+        TRACE.append({**base, "ph": "b", "ts": round((start - TRACE_T0) * 1e6, 1), "args": trace_args})
+        TRACE.append({**base, "ph": "e", "ts": round((end - TRACE_T0) * 1e6, 1)})
+
+@contextlib.contextmanager
+def span(name, cat, **trace_args):
+    """Trace a block as one span (no-op unless --profile)."""
+    if TRACE is None:
+        yield
+        return
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        trace_complete(name, cat, start, time.monotonic(), **trace_args)
+
+def cpu_profiled(fn):
+    """Wrap a worker function so each call is CPU-profiled (no-op unless --profile-cpu)."""
+    if CPU_PROFILES is None:
+        return fn
+    def wrapper(*a, **kw):
+        prof = cProfile.Profile()
+        with TRACE_LOCK:
+            CPU_PROFILES.append(prof)
+        return prof.runcall(fn, *a, **kw)
+    return wrapper
+
+def start_profiling(cpu=False):
+    global TRACE, CPU_PROFILES
+    TRACE = []
+    if cpu:
+        CPU_PROFILES = [cProfile.Profile()]
+        CPU_PROFILES[0].enable()   # main thread
+
+def stop_profiling(trace_path):
+    """Write the trace (and .prof next to it) collected since start_profiling()."""
+    if CPU_PROFILES:
+        CPU_PROFILES[0].disable()
+        stats = pstats.Stats(CPU_PROFILES[0])
+        for prof in CPU_PROFILES[1:]:
+            stats.add(prof)
+        prof_path = os.path.splitext(trace_path)[0] + ".prof"
+        stats.dump_stats(prof_path)
+        print(f"🔬 CPU profile: {prof_path}  (python3 -m pstats {prof_path})")
+    with TRACE_LOCK:
+        events = [{"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": name}}
+                  for tid, name in TRACE_THREADS.items()] + TRACE
+    os.makedirs(os.path.dirname(trace_path), exist_ok=True)
+    write_json_atomic(trace_path, {"traceEvents": events, "displayTimeUnit": "ms"})
+    print(f"🔬 Trace: {trace_path}  ({len(events)} events, open in ui.perfetto.dev)")
+
+# ─────────────────────────────────────────────────────────────
+# HTTP CLIENT  (shared by OpenAI, Replicate, Wikimedia)
+# Keeps idle keep-alive connections per host, so polls and
+# downloads to the same host skip the TCP+TLS handshake.
+# ─────────────────────────────────────────────────────────────
+HTTP_TIMEOUT   = float(os.environ.get("HTTP_TIMEOUT", "60"))
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", "8"))   # idle connections kept per host
+HTTP_GZIP      = os.environ.get("HTTP_GZIP", "1") != "0"      # ask for gzip on JSON responses
+HTTP_POOLS     = {}
+HTTP_POOL_LOCK = threading.Lock()
+SSL_CONTEXT    = ssl.create_default_context()
+
+class PooledResponse:
+    """Streaming response; hands its connection back to the pool when closed."""
+
+    def __init__(self, url, pool_key, conn, resp, decode_gzip, metric=None):
+        self.url, self.pool_key, self.conn, self.resp = url, pool_key, conn, resp
+        self.status, self.headers = resp.status, resp.headers
+        self.decoder = (zlib.decompressobj(16 + zlib.MAX_WBITS)
+                        if decode_gzip and resp.getheader("Content-Encoding", "") == "gzip" else None)
+        self.buf = b""
+        self.metric, self.bytes_in = metric, 0   # recorded on close
+
+    def read(self, n=-1):
+        if not self.decoder:
+            data = self.resp.read() if n is None or n < 0 else self.resp.read(n)
+            self.bytes_in += len(data)
+            return data
+        while n is None or n < 0 or len(self.buf) < n:
+            raw = self.resp.read(CHUNK_SIZE)
+            self.bytes_in += len(raw)
+            if not raw:
+                self.buf += self.decoder.flush()
+                break
+            self.buf += self.decoder.decompress(raw)
+        if n is None or n < 0:
+            out, self.buf = self.buf, b""
+        else:
+            out, self.buf = self.buf[:n], self.buf[n:]
+        return out
+
+    def close(self):
+        if self.metric:
+            metric, self.metric = self.metric, None
+            start = metric.pop("start")
+            record_request(**metric, seconds=round(time.monotonic() - start, 4),
+                           status=self.status, bytes_in=self.bytes_in)
+        if self.conn is None:
+            return
+        # Drain a small unread tail so the connection stays reusable
+        if not self.resp.isclosed() and self.resp.length is not None and self.resp.length <= CHUNK_SIZE:
+            self.resp.read()
+        if self.resp.isclosed() and not self.resp.will_close:
+            with HTTP_POOL_LOCK:
+                idle = HTTP_POOLS.setdefault(self.pool_key, [])
+                if len(idle) < HTTP_POOL_SIZE:
+                    idle.append(self.conn)
+                    self.conn = None
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+HTTP_IDEMPOTENT = ("GET", "HEAD", "PUT", "DELETE", "OPTIONS")
+
+def http_request(method, url, body=None, headers=None, timeout=None, gzip=False, redirects=5, metric=None,
+                 idempotent=None):
+    """Send a request over a pooled connection. Raises urllib.error.HTTPError on 4xx/5xx.
+    `metric` is the (provider, op) the call is recorded under (default: host, method).
+    A stale keep-alive connection is retried on a fresh one only if the request can't have
+    reached the server yet, or it is `idempotent` (default: by method) — a paid POST isn't."""
+    start = time.monotonic()
+    parts = urllib.parse.urlsplit(url)
+    provider, op = metric or (parts.hostname, method.lower())
+    pool_key = (parts.scheme, parts.hostname, parts.port)
+    path = parts.path + (f"?{parts.query}" if parts.query else "")
+    headers = dict(headers or {})
+    headers.setdefault("Accept-Encoding", "gzip" if gzip else "identity")
+    timeout = timeout or HTTP_TIMEOUT
+    if idempotent is None:
+        idempotent = method in HTTP_IDEMPOTENT
+
+    for attempt in range(2):
+        with HTTP_POOL_LOCK:
+            idle = HTTP_POOLS.get(pool_key)
+            conn = idle.pop() if idle else None
+        reused = conn is not None
+        if conn is None:
+            if parts.scheme == "https":
+                conn = http.client.HTTPSConnection(parts.hostname, parts.port, timeout=timeout, context=SSL_CONTEXT)
+            else:
+                conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=timeout)
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+        sent = False
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            sent = True
+            resp = conn.getresponse()
+            break
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+            conn.close()
+            # only a stale keep-alive connection is retried, and a POST only if it never went out
+            if not reused or attempt or (sent and not idempotent):
+                record_request(provider, op, round(time.monotonic() - start, 4), "error",
+                               bytes_out=len(body or b""), retries=attempt)
+                raise
+        except Exception:
+            conn.close()
+            record_request(provider, op, round(time.monotonic() - start, 4), "error",
+                           bytes_out=len(body or b""), retries=attempt)
+            raise
+
+    observe_rate_limit_headers(provider, resp.headers)
+    response = PooledResponse(url, pool_key, conn, resp, gzip,
+                              {"provider": provider, "op": op, "start": start,
+                               "bytes_out": len(body or b""), "retries": attempt})
+    if resp.status in (301, 302, 303, 307, 308) and redirects:
+        location = urllib.parse.urljoin(url, resp.getheader("Location", ""))
+        response.read()
+        response.close()
+        if resp.status == 303:
+            method, body, idempotent = "GET", None, True
+        return http_request(method, location, body, headers, timeout, gzip, redirects - 1, metric, idempotent)
+    if resp.status >= 400:
+        error_body = response.read()
+        response.close()
+        raise urllib.error.HTTPError(url, resp.status, f"{resp.reason}: {error_body[:200]!r}",
+                                     resp.headers, io.BytesIO(error_body))
+    return response
+
+def http_json(method, url, payload=None, headers=None, timeout=None, metric=None):
+    """JSON request/response helper on top of http_request."""
+    headers = dict(headers or {})
+    body = None
+    if payload is not None:
+        body = json.dumps(payload).encode()
+        headers.setdefault("Content-Type", "application/json")
+    with http_request(method, url, body, headers, timeout, gzip=HTTP_GZIP, metric=metric) as resp:
+        raw = resp.read()
+    with span("json decode", "cpu", bytes=len(raw)):
+        return json.loads(raw)
+
+# ─────────────────────────────────────────────────────────────
+# IMAGE CACHE  (content-addressed prompt → image, LRU by size)
+# Key = sha256 of (provider, model, prompt, size, steps), so the
+# same event + art style weeks later reuses the paid image.
+# ─────────────────────────────────────────────────────────────
+CACHE_DIR       = os.environ.get("IMAGE_CACHE_DIR", os.path.expanduser("~/.cache/ai-news-quiz/images"))
+CACHE_BUDGET_MB = float(os.environ.get("IMAGE_CACHE_MB", "500"))
+CACHE_LOCK      = threading.Lock()
+
+def cache_key(provider, model, prompt, size, steps=None):
+    """Stable hash of everything that determines the generated image."""
+    spec = json.dumps([provider, model, prompt, size, steps], ensure_ascii=False)
+    return hashlib.sha256(spec.encode()).hexdigest()
+
+def load_cache_index():
+    path = os.path.join(CACHE_DIR, "index.json")
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_cache_index(index):
+    path = os.path.join(CACHE_DIR, "index.json")
+    with open(path + ".tmp", "w") as f:
+        json.dump(index, f)
+    os.replace(path + ".tmp", path)
+
+def cache_get(key, out_path):
+    """Copy a cached image to out_path and mark it recently used.
+    Returns the written file's digest on a hit, None on a miss."""
+    if not CACHE_BUDGET_MB:
+        return None
+    with CACHE_LOCK:
+        index = load_cache_index()
+        blob = os.path.join(CACHE_DIR, f"{key}.png")
+        if key not in index or not os.path.exists(blob):
+            return None
+        with open(blob, "rb") as f:
+            written = write_atomic(out_path, iter_chunks(f))
+        index[key]["last_used"] = time.time()
+        index[key]["hits"] = index[key].get("hits", 0) + 1
+        save_cache_index(index)
+    record_cache_hit(os.path.basename(out_path))
+    return written
+
+def cache_put(key, src_path, **meta):
+    """Store a freshly generated image, then evict least-recently-used blobs over budget."""
+    if not CACHE_BUDGET_MB:
+        return
+    with CACHE_LOCK:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        blob = os.path.join(CACHE_DIR, f"{key}.png")
+        with open(src_path, "rb") as f:
+            write_atomic(blob, iter_chunks(f))
+        index = load_cache_index()
+        now = time.time()
+        index[key] = dict(meta, bytes=os.path.getsize(blob), created=now, last_used=now, hits=0)
+        budget = int(CACHE_BUDGET_MB * 1024 * 1024)
+        total = sum(e["bytes"] for e in index.values())
+        for old_key in sorted(index, key=lambda k: index[k]["last_used"]):
+            if total <= budget or old_key == key:
+                break
+            total -= index.pop(old_key)["bytes"]
+            try:
+                os.remove(os.path.join(CACHE_DIR, f"{old_key}.png"))
+            except FileNotFoundError:
+                pass
+        save_cache_index(index)
+
+# ─────────────────────────────────────────────────────────────
+# RATE LIMITS  (per-provider gate: concurrency + token bucket)
+# Every generation request (DALL-E image, Flux prediction) takes a
+# token from its provider's bucket, refilled at RPM/60 per second
+# with a burst of the provider's concurrency; slots and tokens are
+# handed out in priority order (news before history/OTD before
+# collages). A 429 pauses the whole provider for Retry-After (or
+# x-ratelimit-reset-*, else a jittered exponential backoff) and the
+# request is retried, instead of dropping the quiz item.
+# ─────────────────────────────────────────────────────────────
+PROVIDER_CONCURRENCY = {
+    "replicate": int(os.environ.get("REPLICATE_CONCURRENCY", "6")),
+    "openai":    int(os.environ.get("OPENAI_CONCURRENCY", "3")),
+}
+PROVIDER_RPM = {   # generation requests per minute; 0 = no limit
+    "replicate": float(os.environ.get("REPLICATE_RPM", "600")),
+    "openai":    float(os.environ.get("OPENAI_RPM", "0")),     # set to your tier's images/min
+}
+ROUTE_PRIORITY = {"news": 0, "history": 1, "otd": 1, "collages": 2}   # lower goes first
+ROUTE_PRIORITY.update(json.loads(os.environ.get("ROUTE_PRIORITY", "{}")))
+RATE_LIMIT_RETRIES = int(os.environ.get("RATE_LIMIT_RETRIES", "5"))
+RATE_LIMIT_BACKOFF = 1.0    # first backoff without a hint (s), doubled per retry
+RATE_LIMIT_MAX_WAIT = 60.0  # cap for backoffs and header hints
+
+class ProviderGate:
+    """Concurrency slots + token bucket for one provider, both granted in priority order."""
+
+    def __init__(self, concurrency, rpm):
+        self.slots = self.burst = max(1, concurrency)
+        self.rate = rpm / 60.0
+        self.tokens, self.stamp = float(self.burst), time.monotonic()
+        self.paused_until = 0.0
+        self.queues = {"slot": [], "token": []}   # heaps of (priority, arrival)
+        self.arrivals = 0
+        self.cond = threading.Condition()
+
+    def _wait(self, kind, priority, take):
+        """Queue for `kind` until first in line and take() returns 0 (else seconds to wait,
+        or None to wait for a release). Returns the seconds spent waiting."""
+        with self.cond:
+            self.arrivals += 1
+            ticket = (priority, self.arrivals)
+            heapq.heappush(self.queues[kind], ticket)
+            start = time.monotonic()
+            while True:
+                delay = take() if self.queues[kind][0] == ticket else None
+                if delay == 0:
+                    heapq.heappop(self.queues[kind])
+                    self.cond.notify_all()
+                    return time.monotonic() - start
+                self.cond.wait(delay)
+
+    def _take_slot(self):
+        if not self.slots:
+            return None
+        self.slots -= 1
+        return 0
+
+    def _take_token(self):
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        if not self.rate:
+            return 0
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens < 1:
+            return (1 - self.tokens) / self.rate
+        self.tokens -= 1
+        return 0
+
+    @contextlib.contextmanager
+    def slot(self, priority):
+        self._wait("slot", priority, self._take_slot)
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.slots += 1
+                self.cond.notify_all()
+
+    def token(self, priority):
+        return self._wait("token", priority, self._take_token)
+
+    def pause(self, seconds):
+        """Hold back every request to this provider for `seconds`."""
+        with self.cond:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0.0
+            self.cond.notify_all()
+
+RATE_GATES = {p: ProviderGate(PROVIDER_CONCURRENCY[p], PROVIDER_RPM[p]) for p in PROVIDER_CONCURRENCY}
+
+def parse_duration(value):
+    """OpenAI-style reset header ("20ms", "1s", "6m0s") → seconds, or None."""
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", value or "")
+    if not parts:
+        return None
+    return sum(float(n) * {"ms": 0.001, "s": 1, "m": 60, "h": 3600}[unit] for n, unit in parts)
+
+def rate_limit_delay(headers, attempt):
+    """How long to back off after a 429: Retry-After, then x-ratelimit-reset-*, else a
+    jittered exponential backoff. A little jitter is added to hints too, so waiting
+    requests don't all come back at the same instant."""
+    hint = parse_retry_after(headers.get("Retry-After"))
+    if hint is None:
+        hint = parse_duration(headers.get("x-ratelimit-reset-requests"))
+    if hint is None:
+        return random.uniform(0.5, 1.0) * min(RATE_LIMIT_MAX_WAIT, RATE_LIMIT_BACKOFF * 2 ** attempt)
+    return min(RATE_LIMIT_MAX_WAIT, hint) * random.uniform(1.0, 1.1)
+
+def observe_rate_limit_headers(provider, headers):
+    """Pause a provider early once its response says no requests are left in the window."""
+    if provider in RATE_GATES and headers.get("x-ratelimit-remaining-requests") == "0":
+        reset = parse_duration(headers.get("x-ratelimit-reset-requests"))
+        if reset:
+            RATE_GATES[provider].pause(min(RATE_LIMIT_MAX_WAIT, reset))
+
+def rate_limited(provider, priority, request):
+    """Run request() (one generation call) once the provider's bucket grants a token.
+    429s, and 503s that carry Retry-After, are retried up to RATE_LIMIT_RETRIES times."""
+    gate = RATE_GATES[provider]
+    for attempt in range(RATE_LIMIT_RETRIES + 1):
+        record_rate_limit(provider, wait_s=gate.token(priority))
+        try:
+            return request()
+        except urllib.error.HTTPError as e:
+            retryable = e.code == 429 or (e.code == 503 and e.headers.get("Retry-After"))
+            if not retryable or attempt == RATE_LIMIT_RETRIES:
+                raise
+            delay = rate_limit_delay(e.headers, attempt)
+            gate.pause(delay)
+            record_rate_limit(provider, throttled=1)
+            print(f"  ⏳ {provider} answered {e.code}, pausing it for {delay:.1f}s (retry {attempt + 1})")
+
 # ─────────────────────────────────────────────────────────────
 # IMAGE GENERATION — DALL-E 3 (Germany, World, Collage)
 # ─────────────────────────────────────────────────────────────
-def generate_image(prompt, filename):
-    url = "https://api.openai.com/v1/images/generations"
+def generate_image(prompt, filename, priority=1):
+    out_path = os.path.join(OUT_DIR, filename)
+    key = cache_key("openai", MODEL, prompt, "1024x1024")
+    written = cache_get(key, out_path)
+    if written:
+        print(f"  ♻️  {filename} from image cache (DALL-E)")
+        return {"image": f"images/{filename}", **written}
+    url = f"{OPENAI_API_BASE}/v1/images/generations"
     data = json.dumps({
         "model": MODEL,
         "prompt": prompt,
@@ -420,35 +1145,31 @@ def generate_image(prompt, filename):
         "quality": "standard",
         "response_format": "b64_json"
     }).encode()
-    req = urllib.request.Request(url, data=data, headers={
+    resp = rate_limited("openai", priority, lambda: http_request("POST", url, data, headers={
         "Authorization": f"Bearer {OPENAI_API_KEY}",
         "Content-Type": "application/json"
-    })
-    with urllib.request.urlopen(req, timeout=90) as resp:
-        result = json.loads(resp.read())
-    img_b64 = result["data"][0]["b64_json"]
-    img_bytes = base64.b64decode(img_b64)
-    out_path = os.path.join(OUT_DIR, filename)
-    with open(out_path, "wb") as f:
-        f.write(img_bytes)
-    print(f"  ✅ Saved {filename} ({len(img_bytes)//1024}KB)")
-    return f"images/{filename}"
+    }, timeout=90, metric=("openai", "generate")))
+    with resp:
+        written = write_atomic(out_path, b64_json_chunks(resp))
+    cache_put(key, out_path, provider="openai", model=MODEL, prompt=prompt)
+    print(f"  ✅ Saved {filename} ({written['bytes']//1024}KB)")
+    return {"image": f"images/{filename}", **written}
 
 # ─────────────────────────────────────────────────────────────
 # IMAGE GENERATION — Replicate Flux Schnell (History)
 # Cheaper than DALL-E 3, great artistic quality, fast (~3s)
 # Falls back to DALL-E if REPLICATE_API_TOKEN is not set.
 # ─────────────────────────────────────────────────────────────
-def generate_image_replicate(prompt, filename):
-    """Generate via Replicate Flux Schnell API. Falls back to DALL-E if no token."""
-    import time
-
-    if not REPLICATE_API_TOKEN:
-        print("  ⚠️  REPLICATE_API_TOKEN not set — falling back to DALL-E 3")
-        return generate_image(prompt, filename)
+def replicate_cache_key(prompt):
+    return cache_key("replicate", REPLICATE_MODEL, prompt, "1:1", 4)
 
-    url = "https://api.replicate.com/v1/models/black-forest-labs/flux-schnell/predictions"
-    data = json.dumps({
+def replicate_submit(prompt, wait=True, priority=1):
+    """Create a Flux prediction (rate-limited). With wait=True Replicate holds the request up to 60s."""
+    headers = {"Authorization": f"Bearer {REPLICATE_API_TOKEN}"}
+    if wait:
+        headers["Prefer"] = "wait"   # synchronous response (up to 60s)
+    url = f"{REPLICATE_API_BASE}/v1/models/{REPLICATE_MODEL}/predictions"
+    return rate_limited("replicate", priority, lambda: http_json("POST", url, {
         "input": {
             "prompt": prompt,
             "num_outputs": 1,
@@ -456,32 +1177,44 @@ def generate_image_replicate(prompt, filename):
             "output_format": "png",
             "num_inference_steps": 4
         }
-    }).encode()
+    }, headers=headers, timeout=90, metric=("replicate", "submit")))
 
-    req = urllib.request.Request(url, data=data, headers={
-        "Authorization": f"Bearer {REPLICATE_API_TOKEN}",
-        "Content-Type": "application/json",
-        "Prefer": "wait"   # synchronous response (up to 60s)
-    })
+def replicate_poll(poll_url):
+    """Re-fetch a prediction. Returns (prediction, Retry-After seconds or None)."""
+    with http_request("GET", poll_url, headers={
+        "Authorization": f"Bearer {REPLICATE_API_TOKEN}"
+    }, timeout=30, gzip=HTTP_GZIP, metric=("replicate", "poll")) as resp:
+        return json.loads(resp.read()), parse_retry_after(resp.headers.get("Retry-After"))
 
-    with urllib.request.urlopen(req, timeout=90) as resp:
-        result = json.loads(resp.read())
+def replicate_cancel(prediction, poll_url):
+    """Cancel a prediction we no longer need, so it stops running (and billing)."""
+    url = prediction.get("urls", {}).get("cancel") or (f"{poll_url}/cancel" if poll_url else "")
+    if not url:
+        return
+    try:
+        with http_request("POST", url, b"", headers={
+            "Authorization": f"Bearer {REPLICATE_API_TOKEN}"
+        }, timeout=30, metric=("replicate", "cancel"), idempotent=True) as resp:
+            resp.read()
+    except Exception as e:
+        print(f"  ⚠️  Could not cancel Replicate prediction {url}: {e}")
 
-    # Poll if still processing (Prefer:wait may time out on busy servers)
-    if result.get("status") in ("starting", "processing"):
-        poll_url = result.get("urls", {}).get("get", "")
-        for _ in range(30):
-            time.sleep(3)
-            req2 = urllib.request.Request(poll_url, headers={
-                "Authorization": f"Bearer {REPLICATE_API_TOKEN}"
-            })
-            with urllib.request.urlopen(req2, timeout=30) as r2:
-                result = json.loads(r2.read())
-            if result.get("status") == "succeeded":
-                break
-        else:
-            raise Exception("Replicate polling timeout")
+def parse_retry_after(value):
+    """Retry-After header (delta-seconds or HTTP date) → seconds, or None."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
 
+def replicate_save(result, prompt, filename, key=None):
+    """Download a finished prediction's output into OUT_DIR (+ image cache, under `key`
+    if given, else the text-to-image key of `prompt`)."""
     if result.get("status") != "succeeded":
         raise Exception(f"Replicate error: {result.get('error', 'unknown')}")
 
@@ -490,203 +1223,1406 @@ def generate_image_replicate(prompt, filename):
         raise Exception("Replicate returned no output")
 
     img_url = output[0] if isinstance(output, list) else output
-    with urllib.request.urlopen(img_url, timeout=60) as resp:
-        img_bytes = resp.read()
+    out_path = os.path.join(OUT_DIR, filename)
+    with http_request("GET", img_url, timeout=60, metric=("replicate", "download")) as resp:
+        written = write_atomic(out_path, iter_chunks(resp))
+
+    cache_put(key or replicate_cache_key(prompt), out_path, provider="replicate", model=REPLICATE_MODEL, prompt=prompt)
+    print(f"  ✅ Saved {filename} via Flux/Replicate ({written['bytes']//1024}KB)")
+    return {"image": f"images/{filename}", **written}
+
+def generate_image_replicate(prompt, filename, priority=1):
+    """Generate via Replicate Flux Schnell API. Falls back to DALL-E if no token."""
+    if not REPLICATE_API_TOKEN:
+        print("  ⚠️  REPLICATE_API_TOKEN not set — falling back to DALL-E 3")
+        return generate_image(prompt, filename, priority)
+
+    written = cache_get(replicate_cache_key(prompt), os.path.join(OUT_DIR, filename))
+    if written:
+        print(f"  ♻️  {filename} from image cache (Flux)")
+        return {"image": f"images/{filename}", **written}
+
+    result = replicate_wait(replicate_submit(prompt, priority=priority), filename)
+    return replicate_save(result, prompt, filename)
 
+def replicate_wait(result, filename):
+    """Poll a prediction until it is done (Prefer:wait may time out on busy servers)."""
+    if result.get("status") in ("starting", "processing"):
+        poll_url = result.get("urls", {}).get("get", "")
+        for polls in range(1, 31):
+            with span("poll wait", "wait", file=filename):
+                time.sleep(3)
+            try:
+                result, _ = replicate_poll(poll_url)
+            except urllib.error.HTTPError as e:
+                if e.code != 429:
+                    raise
+                time.sleep(rate_limit_delay(e.headers, 0))   # throttled poll: just poll again later
+                continue
+            if result.get("status") in REPLICATE_DONE:
+                break
+        else:
+            raise Exception("Replicate polling timeout")
+        record_polls(polls)
+    return result
+
+# ─────────────────────────────────────────────────────────────
+# REPLICATE BATCH MODE
+# Submit every Flux prediction of the run at once (no Prefer:wait),
+# then poll all of them together with per-prediction backoff and
+# download each output as soon as it has succeeded.
+# ─────────────────────────────────────────────────────────────
+REPLICATE_BATCH         = os.environ.get("REPLICATE_BATCH", "1") != "0"
+REPLICATE_BATCH_TIMEOUT = float(os.environ.get("REPLICATE_BATCH_TIMEOUT", "180"))
+REPLICATE_DONE          = ("succeeded", "failed", "canceled")
+
+def run_replicate_batch(jobs):
+    """Run the Replicate attempt of every job via submit-all-then-poll; each outcome goes
+    to attempt_finished like a single attempt's. Predictions whose job was meanwhile won
+    by a hedge are no longer polled."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    def settle(job, result=None, error=None, abandoned=False):
+        with ROUTE_LOCK:
+            if job.get("batch_settled"):
+                return
+            job["batch_settled"] = True
+        attempt_finished(job, "replicate", attempt_name(job, "replicate"), result, error, abandoned)
+
+    def submit(job):
+        job["submitted_at"] = job["running_since"] = time.monotonic()
+        if job["winner"] or breaker_open("replicate"):
+            settle(job)   # hand over to the next provider of the route
+            return None
+        print(f"\n{job['label']}")
+        name = attempt_name(job, "replicate")
+        written = cache_get(replicate_cache_key(job["prompt"]), os.path.join(OUT_DIR, name))
+        if written:
+            print(f"  ♻️  {job['filename']} from image cache (Flux)")
+            settle(job, {"image": f"images/{name}", **written})
+            return None
+        journaled = JOURNAL["jobs"].get(job["filename"], {})
+        if journaled.get("status") == "submitted" and journaled.get("prediction"):
+            # Submitted before a crash: poll that prediction instead of paying again
+            print(f"  ↩️  {job['filename']}: resuming Replicate prediction from journal")
+            return {"job": job, "prediction": {"status": "processing"}, "retry_after": None, "delay": 1.0, "polls": 0,
+                    "poll_url": journaled["prediction"], "next": time.monotonic()}
+        try:
+            prediction = replicate_submit(job["prompt"], wait=False, priority=job["priority"])
+        except Exception as e:
+            print(f"  ❌ Error ({job['filename']}): {e}")
+            settle(job, error=e)
+            return None
+        poll_url = prediction.get("urls", {}).get("get", "")
+        journal_job(job["filename"], status="submitted", prediction=poll_url)
+        return {"job": job, "prediction": prediction, "retry_after": None, "delay": 1.0, "polls": 0,
+                "poll_url": poll_url, "next": time.monotonic() + 1.0}
+
+    def poll(p):
+        p["polls"] += 1
+        try:
+            p["prediction"], p["retry_after"] = replicate_poll(p["poll_url"])
+        except urllib.error.HTTPError as e:
+            if e.code != 429 and e.code < 500:
+                return e
+            p["retry_after"] = parse_retry_after(e.headers.get("Retry-After"))
+        except OSError as e:   # network hiccup: just try again later
+            print(f"  ⚠️  Poll failed for {p['job']['filename']}: {e}")
+        except Exception as e:
+            return e
+        return None
+
+    def hedge_checkpoint(job, when):
+        """Pull a poll forward to just before the job's hedge deadline, so only a prediction
+        that is really still running gets hedged (not one that finished between polls)."""
+        if not HEDGE_AFTER["replicate"] or job.get("hedged") or "running_since" not in job:
+            return when
+        checkpoint = job["running_since"] + HEDGE_AFTER["replicate"] - HEDGE_POLL_MARGIN
+        return checkpoint if time.monotonic() < checkpoint < when else when
+
+    def finish(job, result):
+        try:
+            written, error = replicate_save(result, job["prompt"], attempt_name(job, "replicate")), None
+        except Exception as e:
+            written, error = None, e
+            print(f"  ❌ Error ({job['filename']}): {e}")
+        trace_async(attempt_name(job, "replicate"), "job", job["submitted_at"], time.monotonic(),
+                    provider="replicate", batch=True, ok=written is not None)
+        settle(job, written, error)
+    finish = cpu_profiled(finish)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, PROVIDER_CONCURRENCY["replicate"])) as pool:
+            pending = []
+            for p in pool.map(submit, sorted(jobs, key=lambda j: j["priority"])):
+                if p and p["prediction"].get("status") in REPLICATE_DONE:
+                    pool.submit(finish, p["job"], p["prediction"])
+                elif p:
+                    pending.append(p)
+            if pending:
+                print(f"\n⏳ Polling {len(pending)} Replicate predictions...")
+
+            deadline = time.monotonic() + REPLICATE_BATCH_TIMEOUT
+            while pending and time.monotonic() < deadline:
+                with span("poll wait", "wait", pending=len(pending)):   # wake at least every second for hedge wins
+                    time.sleep(min(1.0, max(0.0, min(p["next"] for p in pending) - time.monotonic())))
+                for p in [p for p in pending if p["job"]["winner"]]:
+                    pending.remove(p)   # a hedge already delivered this image: stop paying for it
+                    replicate_cancel(p["prediction"], p["poll_url"])
+                    settle(p["job"], abandoned=True)
+                due = [p for p in pending if p["next"] <= time.monotonic()]
+                for p, error in zip(due, list(pool.map(poll, due))):
+                    if error is not None:
+                        print(f"  ❌ Error ({p['job']['filename']}): {error}")
+                        pending.remove(p)
+                        settle(p["job"], error=error)
+                    elif p["prediction"].get("status") in REPLICATE_DONE:
+                        pending.remove(p)
+                        with ROUTE_LOCK:
+                            p["job"].pop("running_since", None)   # done: no hedge while it downloads
+                        record_polls(p["polls"])
+                        pool.submit(finish, p["job"], p["prediction"])   # download while others still poll
+                    else:
+                        p["delay"] = min(p["delay"] * 1.5, 10.0)
+                        p["next"] = time.monotonic() + (p["delay"] if p["retry_after"] is None else p["retry_after"])
+                        if p["retry_after"] is None:
+                            p["next"] = hedge_checkpoint(p["job"], p["next"])
+            for p in pending:
+                print(f"  ❌ Error ({p['job']['filename']}): Replicate polling timeout")
+                settle(p["job"], error=Exception("Replicate polling timeout"))
+    finally:
+        for job in jobs:   # whatever happened above, every attempt gets an outcome
+            settle(job, error=Exception("Replicate batch ended without a result"))
+
+# ─────────────────────────────────────────────────────────────
+# IMAGE ROUTING  (provider order per category, hedging, breakers)
+# Each category has an ordered list of providers. A job starts on
+# the first one whose circuit is closed. If that attempt is still
+# running after the provider's hedge delay, the next provider gets
+# the same prompt too, and whichever image lands first is kept.
+# A failed attempt falls through to the next provider right away.
+# After BREAKER_FAILURES failures in a row a provider's circuit
+# opens and it is skipped for BREAKER_COOLDOWN seconds.
+# ─────────────────────────────────────────────────────────────
+IMAGE_ROUTES = {
+    "news":     ["replicate", "openai"],
+    "history":  ["replicate", "openai"],
+    "otd":      ["replicate", "openai"],
+    "collages": ["openai", "replicate"],
+}
+# e.g. IMAGE_ROUTES='{"collages": ["openai"], "news": ["openai", "replicate"]}'
+IMAGE_ROUTES.update(json.loads(os.environ.get("IMAGE_ROUTES", "{}")))
+HEDGE_POLL_MARGIN = 1.0   # batch mode polls a prediction this long before hedging it
+HEDGE_AFTER = {   # seconds before the next provider is asked as well; 0 = never hedge
+    "replicate": float(os.environ.get("REPLICATE_HEDGE_AFTER", "25")),
+    "openai":    float(os.environ.get("OPENAI_HEDGE_AFTER", "60")),
+}
+BREAKER_FAILURES = int(os.environ.get("BREAKER_FAILURES", "3"))
+BREAKER_COOLDOWN = float(os.environ.get("BREAKER_COOLDOWN", "300"))
+BREAKERS         = {p: {"failures": 0, "open_until": 0.0} for p in HEDGE_AFTER}
+ROUTE_LOCK       = threading.RLock()
+JOBS_CHANGED     = threading.Event()   # set whenever a job gets its final outcome
+
+def route_providers(route):
+    """The route's providers that have credentials, in order (all of them if none has)."""
+    providers = [p for p in IMAGE_ROUTES.get(route) or ["replicate", "openai"] if p in HEDGE_AFTER]
+    configured = [p for p in providers if (REPLICATE_API_TOKEN if p == "replicate" else OPENAI_API_KEY)]
+    return configured or providers
+
+def breaker_open(provider):
+    return time.monotonic() < BREAKERS[provider]["open_until"]
+
+def breaker_record(provider, ok):
+    """Reset the failure streak on success; open the circuit once it reaches BREAKER_FAILURES.
+    After the cooldown requests go through again, and one more failure re-opens it."""
+    with ROUTE_LOCK:
+        breaker = BREAKERS[provider]
+        if ok:
+            breaker["failures"] = 0
+            return
+        breaker["failures"] += 1
+        if breaker["failures"] < BREAKER_FAILURES or breaker_open(provider):
+            return
+        breaker["open_until"] = time.monotonic() + BREAKER_COOLDOWN
+    record_routing("breaker_trips", provider)
+    print(f"  🔌 {provider} failed {breaker['failures']}× in a row — circuit open for {BREAKER_COOLDOWN:.0f}s")
+
+def next_provider(job):
+    """The job's first untried provider with a closed circuit, or None."""
+    return next((p for p in job["providers"] if p not in job["tried"] and not breaker_open(p)), None)
+
+def attempt_name(job, provider):
+    """Each attempt writes its own file (hi1.replicate.png); the winner is renamed to hi1.png."""
+    stem, ext = os.path.splitext(job["filename"])
+    return f"{stem}.{provider}{ext}"
+
+def book_attempt(job, provider):
+    with ROUTE_LOCK:
+        if not job["running"]:
+            job.pop("running_since", None)
+        job["tried"].append(provider)
+        job["running"] += 1
+
+def start_attempt(job, provider):
+    """Run one provider's attempt at a job in a background thread."""
+    book_attempt(job, provider)
+    threading.Thread(target=cpu_profiled(run_attempt), args=(job, provider),
+                     name=attempt_name(job, provider), daemon=True).start()
+
+def run_attempt(job, provider):
+    """Generate the job's image with one provider, within that provider's concurrency cap."""
+    name = attempt_name(job, provider)
+    generate = generate_image_replicate if provider == "replicate" else generate_image
+    result = error = None
+    queued = time.monotonic()
+    with RATE_GATES[provider].slot(job["priority"]):
+        if job["winner"] is None and not breaker_open(provider):
+            start = job["running_since"] = time.monotonic()
+            print(f"\n{job['label']}" + (f"  [→ {provider}]" if provider != job["tried"][0] else ""))
+            try:
+                result = generate(job["prompt"], name, job["priority"])
+            except Exception as e:
+                error = e
+                print(f"  ❌ Error ({job['filename']} via {provider}): {e}")
+            trace_async(name, "job", start, time.monotonic(), provider=provider,
+                        queued_ms=round((start - queued) * 1000), ok=result is not None)
+    attempt_finished(job, provider, name, result, error)
+
+def attempt_finished(job, provider, name, result, error, abandoned=False):
+    """Book one attempt's outcome (result and error both None: it was skipped). The first
+    image wins the job and is moved into place; a later one is dropped. A failure moves on
+    to the next provider, and the job fails once no provider is left. `abandoned` marks
+    paid work cancelled because a hedge won first: booked as hedge-lost like a late image."""
+    if result is not None or error is not None:
+        breaker_record(provider, result is not None)
+    with ROUTE_LOCK:
+        job["running"] -= 1
+        won = result is not None and job["winner"] is None
+        if won:
+            job["winner"] = provider
+        fallback = None
+        if job["winner"] is None and not job["running"]:
+            fallback = next_provider(job)
+            if fallback:
+                book_attempt(job, fallback)
+        failed = job["winner"] is None and not job["running"]
+    path = os.path.join(job["out_dir"], name)
+    if won:
+        os.replace(path, os.path.join(job["out_dir"], job["filename"]))
+        if was_cache_hit(name):
+            record_cache_hit(job["filename"])
+        job["entry"].update(result, image=f"images/{job['filename']}")
+        if job.get("hedged") and provider != job["tried"][0]:
+            record_routing("hedge_wins")
+        job["provider"] = provider
+    elif result is not None:
+        # Another provider was faster; this image only stays in the cache
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+        if not was_cache_hit(name):
+            record_job(job["stage"], provider, job["filename"], "hedge-lost")
+    elif abandoned:
+        record_job(job["stage"], provider, job["filename"], "hedge-lost")
+    if fallback:
+        print(f"  ↪️  {job['filename']}: {provider} gave no image, trying {fallback}")
+        record_routing("fallbacks")
+        threading.Thread(target=cpu_profiled(run_attempt), args=(job, fallback),
+                         name=attempt_name(job, fallback), daemon=True).start()
+    if won or failed:
+        job_finished(job)
+        job["done"].set()
+        JOBS_CHANGED.set()
+
+def hedge_if_slow(job, now):
+    """Also ask the next provider once the only running attempt is past its hedge delay."""
+    with ROUTE_LOCK:
+        if job["winner"] or job.get("hedged") or job["running"] != 1 or "running_since" not in job:
+            return
+        provider = job["tried"][-1]
+        if not HEDGE_AFTER[provider] or now - job["running_since"] < HEDGE_AFTER[provider]:
+            return
+        hedge = next_provider(job)
+        if hedge is None:
+            return
+        job["hedged"] = True
+    print(f"  🏁 {job['filename']}: {provider} still busy after {HEDGE_AFTER[provider]:.0f}s, also asking {hedge}")
+    record_routing("hedged")
+    start_attempt(job, hedge)
+
+# ─────────────────────────────────────────────────────────────
+# IMAGE JOB SCHEDULER
+# All images of a run are planned up front, then rendered
+# concurrently within each provider's gate (see RATE LIMITS).
+# ─────────────────────────────────────────────────────────────
+IMAGE_JOBS = []
+
+def queue_image(route, prompt, filename, label, entry, force=False, journal=None):
+    """Plan one image job on `route` (a key of IMAGE_ROUTES). `entry` is the quiz item;
+    its "image" (+ sha256/bytes) is filled in once the job succeeds, or right away if
+    the file already exists and still shows this prompt (force=True always re-renders).
+    `journal` holds extra fields (event/style ids) for the run journal."""
     out_path = os.path.join(OUT_DIR, filename)
-    with open(out_path, "wb") as f:
-        f.write(img_bytes)
-    print(f"  ✅ Saved {filename} via Flux/Replicate ({len(img_bytes)//1024}KB)")
-    return f"images/{filename}"
+    providers = route_providers(route)
+    prompt_hash = hashlib.sha256(prompt.encode()).hexdigest()[:16]
+    shown = BUILD_STATE["images"].get(filename, prompt_hash)   # untracked files are trusted
+    planned = dict(journal or {}, provider=providers[0], prompt_hash=prompt_hash, output=f"images/{filename}")
+    # writes are atomic, so an existing file is complete
+    if os.path.exists(out_path) and not force and shown == prompt_hash:
+        print(f"  ⏭  {filename} already exists, skipping")
+        BUILD_STATE["images"][filename] = prompt_hash
+        entry.update(image=f"images/{filename}", **file_digest(out_path))
+        journal_job(filename, **planned, status="done", sha256=entry["sha256"])
+        record_job(METRICS["stage"], providers[0], filename, "skipped")
+        return entry
+    previous = JOURNAL["jobs"].get(filename, {})
+    if previous.get("prompt_hash") != prompt_hash or previous.get("status") != "submitted":
+        journal_job(filename, **planned, status="planned")
+    IMAGE_JOBS.append({"route": route, "providers": providers, "provider": providers[0],
+                       "priority": ROUTE_PRIORITY.get(route, 1), "prompt": prompt,
+                       "filename": filename, "prompt_hash": prompt_hash, "label": label, "entry": entry,
+                       "stage": METRICS["stage"]})
+    return entry
+
+def job_finished(job):
+    """Record a job's outcome in the build state + journal as soon as it is known."""
+    if job["entry"]["image"]:
+        BUILD_STATE["images"][job["filename"]] = job["prompt_hash"]
+        journal_job(job["filename"], status="done", sha256=job["entry"].get("sha256"))
+        outcome = "cached" if was_cache_hit(job["filename"]) else "rendered"
+    else:
+        journal_job(job["filename"], status="failed")
+        outcome = "failed"
+    record_job(job["stage"], job["provider"], job["filename"], outcome)
+
+def run_image_jobs(jobs):
+    """Render all planned jobs concurrently along their routes; failed jobs leave
+    entry["image"] = None. Returns once every job has an outcome: attempts that lost
+    a hedge are not waited for."""
+    if not jobs:
+        return
+    if not REPLICATE_API_TOKEN and any("replicate" in IMAGE_ROUTES.get(j["route"], ()) for j in jobs):
+        print("  ⚠️  REPLICATE_API_TOKEN not set — Replicate jobs go to the next provider of their route")
+    for job in jobs:
+        job.update(tried=[], running=0, winner=None, done=threading.Event(), out_dir=OUT_DIR)
+
+    # Replicate-first jobs go through batch submit+poll; everything else gets its own attempt
+    first = [next_provider(j) for j in jobs]
+    batch = [j for j, p in zip(jobs, first) if p == "replicate" and REPLICATE_BATCH and REPLICATE_API_TOKEN]
+
+    start = time.monotonic()
+    print(f"\n🚀 Rendering {len(jobs)} images concurrently "
+          f"({', '.join(f'{p}≤{n}' for p, n in PROVIDER_CONCURRENCY.items())}"
+          f"{', Replicate batch mode' if batch else ''})...")
+    for job, provider in zip(jobs, first):
+        if provider is None:
+            print(f"  ❌ Error ({job['filename']}): every provider of its route has an open circuit")
+            job_finished(job)
+            job["done"].set()
+        elif job in batch:
+            book_attempt(job, provider)
+        else:
+            start_attempt(job, provider)
+    batch_thread = threading.Thread(target=run_replicate_batch, args=(batch,), name="replicate-batch", daemon=True)
+    if batch:
+        batch_thread.start()
+
+    # Hedge attempts that run too long until every job has its image or has failed
+    while True:
+        JOBS_CHANGED.clear()
+        waiting = [j for j in jobs if not j["done"].is_set()]
+        if not waiting:
+            break
+        for job in waiting:
+            hedge_if_slow(job, time.monotonic())
+        JOBS_CHANGED.wait(0.25)
+    if batch:   # let it cancel and book the predictions that hedges beat
+        batch_thread.join(5.0)
+    done = sum(1 for j in jobs if j["entry"]["image"])
+    print(f"\n⏱  {done}/{len(jobs)} images rendered in {time.monotonic() - start:.1f}s")
 
 # ─────────────────────────────────────────────────────────────
-# SETUP
+# WORKER PROCESSES  (CPU-bound image work after the render)
+# Pools use fork so workers don't re-run this script top to bottom.
+# Forking while another thread holds a lock (trace, metrics, cache,
+# HTTP pool) can deadlock the child, so the pool only starts once
+# every other thread has finished — a hedge loser may still be
+# talking to its API. If that takes longer than FORK_QUIESCE_TIMEOUT
+# the work runs in this process instead.
 # ─────────────────────────────────────────────────────────────
-os.makedirs(OUT_DIR, exist_ok=True)
-today = datetime.date.today().isoformat()
+FORK_QUIESCE_TIMEOUT = float(os.environ.get("FORK_QUIESCE_TIMEOUT", "30"))
+
+def quiesce_threads(timeout):
+    """Join every thread but the main one; True if none is left running."""
+    deadline = time.monotonic() + timeout
+    for thread in threading.enumerate():
+        if thread is not threading.main_thread():
+            thread.join(max(0.0, deadline - time.monotonic()))
+    return threading.active_count() == 1
+
+def worker_map(fn, tasks, workers):
+    """{key: fn(*args)} for tasks = {key: (label, args)}, in a fork pool when that is safe.
+    A failed task is reported with its label and left out of the result."""
+    from concurrent.futures import ProcessPoolExecutor
+    import multiprocessing
+
+    results = {}
+    if "fork" in multiprocessing.get_all_start_methods() and len(tasks) > 1:
+        if quiesce_threads(FORK_QUIESCE_TIMEOUT):
+            with ProcessPoolExecutor(max_workers=max(1, min(workers, len(tasks))),
+                                     mp_context=multiprocessing.get_context("fork")) as pool:
+                futures = {key: pool.submit(fn, *args) for key, (_, args) in tasks.items()}
+                for key, fut in futures.items():
+                    try:
+                        results[key] = fut.result()
+                    except Exception as ex:
+                        print(f"  ⚠️  {tasks[key][0]} failed: {ex}")
+            return results
+        print(f"  ⚠️  {threading.active_count() - 1} background thread(s) still busy — working in-process")
+    for key, (label, args) in tasks.items():
+        try:
+            results[key] = fn(*args)
+        except Exception as ex:
+            print(f"  ⚠️  {label} failed: {ex}")
+    return results
 
 # ─────────────────────────────────────────────────────────────
-# ARCHIVE YESTERDAY'S QUIZ
+# LOCAL COLLAGES  (COLLAGE_ENGINE=local)
+# Instead of 4 DALL-E calls, each collage is composited from the
+# category's own story images (de1..4 / wo1..4) once they are
+# rendered: a jittered 2×2 layout with feathered seams, the tiles'
+# colours pulled towards a common mean/spread (NumPy if available),
+# then the style's grading + brushwork over the whole picture.
+# Composites are built in a process pool (Pillow); COLLAGE_REFINE=1
+# adds one Flux img2img pass per collage to fuse the seams.
 # ─────────────────────────────────────────────────────────────
-if os.path.exists(JSON_PATH):
+COLLAGE_ENGINE          = os.environ.get("COLLAGE_ENGINE", "api")   # "api" (DALL-E) or "local"
+COLLAGE_SIZE            = int(os.environ.get("COLLAGE_SIZE", "1024"))
+COLLAGE_REFINE          = os.environ.get("COLLAGE_REFINE", "0") != "0"
+COLLAGE_REFINE_MODEL    = os.environ.get("COLLAGE_REFINE_MODEL", "black-forest-labs/flux-dev")
+COLLAGE_REFINE_STRENGTH = float(os.environ.get("COLLAGE_REFINE_STRENGTH", "0.35"))
+COLLAGE_REFINE_PROMPT   = ("A single cohesive painting in the style of {style}, four scenes flowing into "
+                           "one another, unified palette and brushwork")
+COLLAGE_LOOKS = {   # style id → grading of the finished composite
+    "bosch":   {"saturation": 0.75, "contrast": 1.25, "tint": (110, 78, 40), "tint_amount": 0.35,
+                "brush": 3, "vignette": 0.6, "grain": 12},
+    "vangogh": {"saturation": 1.6, "contrast": 1.1, "tint": (60, 90, 170), "tint_amount": 0.2,
+                "brush": 7, "vignette": 0.25, "grain": 0},
+}
+COLLAGE_PLAIN_LOOK = {"saturation": 1.0, "contrast": 1.0, "tint": (128, 128, 128), "tint_amount": 0.0,
+                      "brush": 0, "vignette": 0.3, "grain": 0}
+
+def collage_cells(count, cx, cy, size):
+    """Layout boxes (x0, y0, x1, y1) for 2–4 tiles split at (cx, cy)."""
+    if count == 2:
+        return [(0, 0, cx, size), (cx, 0, size, size)]
+    if count == 3:
+        return [(0, 0, cx, cy), (cx, 0, size, cy), (0, cy, size, size)]
+    return [(0, 0, cx, cy), (cx, 0, size, cy), (0, cy, cx, size), (cx, cy, size, size)]
+
+def harmonise_tiles(tiles, strength=0.6):
+    """Pull each tile's per-channel mean/spread part of the way to the group's."""
+    if np is None:
+        return tiles
+    from PIL import Image
+    arrays = [np.asarray(t, dtype=np.float32) for t in tiles]
+    stats = np.array([[a.reshape(-1, 3).mean(0), a.reshape(-1, 3).std(0) + 1e-3] for a in arrays])   # (n, 2, 3)
+    target_mean, target_std = stats[:, 0].mean(0), stats[:, 1].mean(0)
+    out = []
+    for a, (mean, std) in zip(arrays, stats):
+        moved = (a - mean) * (target_std / std) + target_mean
+        out.append(Image.fromarray(np.clip(a + (moved - a) * strength, 0, 255).astype(np.uint8)))
+    return out
+
+def apply_look(im, look):
+    """Colour grading, brushwork, vignette and grain for one style."""
+    from PIL import Image, ImageChops, ImageEnhance, ImageFilter
+    im = ImageEnhance.Color(im).enhance(look["saturation"])
+    im = ImageEnhance.Contrast(im).enhance(look["contrast"])
+    if look["tint_amount"]:
+        tinted = ImageChops.soft_light(im, Image.new("RGB", im.size, look["tint"]))
+        im = Image.blend(im, tinted, look["tint_amount"])
+    if look["brush"]:
+        im = im.filter(ImageFilter.MedianFilter(look["brush"]))
+    if look["vignette"]:
+        mask = Image.radial_gradient("L").resize(im.size).point(lambda v: int(v * look["vignette"]))
+        im = Image.composite(Image.new("RGB", im.size), im, mask)
+    if look["grain"]:
+        noise = Image.effect_noise(im.size, look["grain"]).convert("RGB")
+        im = Image.blend(im, ImageChops.overlay(im, noise), 0.5)
+    return im
+
+def compose_collage(sources, out_path, look, seed):
+    """Blend 2–4 story images into one COLLAGE_SIZE² collage (runs in a worker process)."""
+    from PIL import Image, ImageDraw, ImageFilter, ImageOps
+    rng = random.Random(seed)
+    size = COLLAGE_SIZE
+    tiles = []
+    for path in sources:
+        with Image.open(path) as im:
+            tiles.append(im.convert("RGB"))
+    tiles = harmonise_tiles(tiles)
+    cx, cy = (round(size * rng.uniform(0.42, 0.58)) for _ in range(2))
+    overlap = size // 10
+    # Underlay: the blurred average of all tiles, so seams never show bare canvas
+    canvas = ImageOps.fit(tiles[0], (size, size))
+    for i, tile in enumerate(tiles[1:], 2):
+        canvas = Image.blend(canvas, ImageOps.fit(tile, (size, size)), 1 / i)
+    canvas = canvas.filter(ImageFilter.GaussianBlur(size // 32))
+    for tile, (x0, y0, x1, y1) in zip(tiles, collage_cells(len(tiles), cx, cy, size)):
+        box = (max(0, x0 - overlap), max(0, y0 - overlap), min(size, x1 + overlap), min(size, y1 + overlap))
+        w, h = box[2] - box[0], box[3] - box[1]
+        piece = ImageOps.fit(tile, (w, h), Image.LANCZOS, centering=(rng.uniform(0.4, 0.6), 0.5))
+        mask = Image.new("L", (w, h))
+        ImageDraw.Draw(mask).rectangle((x0 - box[0], y0 - box[1], x1 - box[0] - 1, y1 - box[1] - 1), fill=255)
+        canvas.paste(piece, box[:2], mask.filter(ImageFilter.GaussianBlur(overlap / 2)))
+    canvas = apply_look(canvas, look)
+    buf = io.BytesIO()
+    canvas.save(buf, "PNG")
+    return write_atomic(out_path, [buf.getvalue()])
+
+def refine_collage(path, style, filename):
+    """One Flux img2img pass over a composite (cached by composite + prompt). Replaces the file."""
+    prompt = COLLAGE_REFINE_PROMPT.format(style=style)
+    with open(path, "rb") as f:
+        data = f.read()
+    key = cache_key("replicate", COLLAGE_REFINE_MODEL, prompt, hashlib.sha256(data).hexdigest(),
+                    COLLAGE_REFINE_STRENGTH)
+    written = cache_get(key, path)
+    if written:
+        print(f"  ♻️  {filename} refine from image cache (Flux)")
+        return written
+    url = f"{REPLICATE_API_BASE}/v1/models/{COLLAGE_REFINE_MODEL}/predictions"
+    with RATE_GATES["replicate"].slot(ROUTE_PRIORITY.get("collages", 2)):
+        result = rate_limited("replicate", ROUTE_PRIORITY.get("collages", 2), lambda: http_json("POST", url, {
+            "input": {
+                "prompt": prompt,
+                "image": "data:image/png;base64," + base64.b64encode(data).decode(),
+                "prompt_strength": COLLAGE_REFINE_STRENGTH,
+                "num_outputs": 1,
+                "output_format": "png"
+            }
+        }, headers={"Authorization": f"Bearer {REPLICATE_API_TOKEN}", "Prefer": "wait"},
+           timeout=90, metric=("replicate", "refine")))
+        result = replicate_wait(result, filename)
+    return replicate_save(result, prompt, filename, key=key)
+
+def build_local_collages(categories, seed):
+    """quiz_collages-shaped entries composited from each category's rendered images."""
+    from concurrent.futures import ThreadPoolExecutor
+
     try:
-        with open(JSON_PATH) as f:
-            old = json.load(f)
-        old_date = old.get("date", "")
-        if old_date and old_date != today:
-            archive_dir = os.path.join(OUT_DIR, old_date)
-            os.makedirs(archive_dir, exist_ok=True)
-            # Copy + relink category images (germany, world, history)
-            for items in old.get("categories", {}).values():
-                for item in items:
-                    src = os.path.join(WEBROOT, item["image"])
-                    if os.path.exists(src):
-                        fname = os.path.basename(src)
-                        shutil.copy2(src, os.path.join(archive_dir, fname))
-                        item["image"] = f"images/{old_date}/{fname}"
-            # Copy + relink collage images
-            for styles in old.get("collages", {}).values():
-                for info in styles.values():
-                    src = os.path.join(WEBROOT, info["image"])
-                    if os.path.exists(src):
-                        fname = os.path.basename(src)
-                        shutil.copy2(src, os.path.join(archive_dir, fname))
-                        info["image"] = f"images/{old_date}/{fname}"
-            # Copy + relink On This Day images
-            if old.get("onthisday"):
-                for item in old["onthisday"].get("events", []):
-                    src = os.path.join(WEBROOT, item["image"])
-                    if os.path.exists(src):
-                        fname = os.path.basename(src)
-                        shutil.copy2(src, os.path.join(archive_dir, fname))
-                        item["image"] = f"images/{old_date}/{fname}"
-            # Write archived quiz-data-YYYY-MM-DD.json
-            archive_json = os.path.join(WEBROOT, f"quiz-data-{old_date}.json")
-            with open(archive_json, "w") as f:
-                json.dump(old, f, indent=2, ensure_ascii=False)
-            # Update archive-index.json
-            index_path = os.path.join(WEBROOT, "archive-index.json")
-            index = json.load(open(index_path)) if os.path.exists(index_path) else []
-            if old_date not in index:
-                index.insert(0, old_date)
-            with open(index_path, "w") as f:
-                json.dump(index, f)
-            print(f"✅ Archived {old_date} → images/{old_date}/ + quiz-data-{old_date}.json")
-    except Exception as e:
-        print(f"⚠️  Archive skipped: {e}")
+        import PIL  # noqa: F401
+    except ImportError:
+        print("  ⚠️  Pillow not installed — no local collages (set COLLAGE_ENGINE=api)")
+        return {}
+    plan = []
+    for cat_key, styles in COLLAGE_PROMPTS.items():
+        tiles = [it for it in categories.get(cat_key, [])[:4] if it.get("image")]
+        sources = [os.path.join(WEBROOT, it["image"]) for it in tiles]
+        if len(sources) < 2:
+            print(f"  ⚠️  Only {len(sources)} {cat_key} image(s) — skipping its collages")
+            continue
+        for style_key, info in styles.items():
+            filename = f"collage_{cat_key}_{style_key}.png"
+            look = COLLAGE_LOOKS.get(style_key, COLLAGE_PLAIN_LOOK)
+            layout_seed = f"{seed}/{cat_key}/{style_key}"
+            # Stands in for the prompt hash of an API image: same tiles, look and layout, same collage
+            recipe = [style_key, look, layout_seed, [it.get("sha256") for it in tiles]]
+            prompt_hash = hashlib.sha256(json.dumps(recipe).encode()).hexdigest()[:16]
+            plan.append((cat_key, style_key, info["style"], filename, prompt_hash,
+                         (sources, os.path.join(OUT_DIR, filename), look, layout_seed)))
+
+    start = time.monotonic()
+    written = worker_map(compose_collage, {p[3]: (f"Collage {p[3]}", p[5]) for p in plan}, VARIANT_WORKERS)
+    print(f"🎨  Composited {len(written)} collages locally in {time.monotonic() - start:.1f}s")
+
+    refined = set()
+    if COLLAGE_REFINE and REPLICATE_API_TOKEN and written:
+        def refine(item):
+            cat_key, style_key, style, filename, _, args = item
+            try:
+                written[filename] = refine_collage(args[1], style, filename)
+                refined.add(filename)
+            except Exception as ex:
+                print(f"  ⚠️  Refining {filename} failed, keeping the composite: {ex}")
+        with ThreadPoolExecutor(max_workers=len(written)) as pool:
+            list(pool.map(refine, [p for p in plan if p[3] in written]))
+
+    collages = {}
+    for cat_key, style_key, style, filename, prompt_hash, _ in plan:
+        if filename in written:
+            provider = "replicate-img2img" if filename in refined else "local"
+            BUILD_STATE["images"][filename] = prompt_hash   # never a prompt's: a later api run re-renders it
+            journal_job(filename, category=cat_key, style_id=style_key, provider=provider, prompt_hash=prompt_hash,
+                        output=f"images/{filename}", status="done", sha256=written[filename]["sha256"])
+            record_job(METRICS["stage"], provider, filename, "rendered")
+            collages.setdefault(cat_key, {})[style_key] = {
+                "image": f"images/{filename}", "style": style,
+                **{k: written[filename][k] for k in ("sha256", "bytes")}}
+    return collages
+
+# ─────────────────────────────────────────────────────────────
+# RESPONSIVE IMAGE VARIANTS  (AVIF/WebP at several widths)
+# Runs after the image stage in a process pool; needs Pillow
+# (pip install pillow) and is skipped with a warning without it.
+# Variants are named by the source's sha256, so they never go
+# stale, survive archiving, and a backfill can resume.
+# ─────────────────────────────────────────────────────────────
+VARIANT_DIR     = os.path.join(OUT_DIR, "variants")
+VARIANT_WIDTHS  = [int(w) for w in os.environ.get("VARIANT_WIDTHS", "320,640,1024").split(",") if w.strip()]
+VARIANT_WORKERS = int(os.environ.get("VARIANT_WORKERS", str(os.cpu_count() or 2)))
+VARIANT_FORMATS = [   # (mime type, Pillow format, extension, save options) — best first
+    ("image/avif", "AVIF", "avif", {"quality": 50, "speed": 6}),
+    ("image/webp", "WEBP", "webp", {"quality": 80, "method": 4}),
+]
+
+def encode_variants(src_path, sha256):
+    """Encode all variants of one image (runs in a worker process).
+    Returns [{"src", "w", "type", "bytes"}, ...], best format first."""
+    from PIL import Image
+    try:
+        import pillow_avif  # noqa: F401  (AVIF plugin for Pillow < 11.2)
+    except ImportError:
+        pass
+    Image.init()
+
+    os.makedirs(VARIANT_DIR, exist_ok=True)
+    variants = []
+
+    def save(path, image, fmt, **opts):
+        if not os.path.exists(path):
+            buf = io.BytesIO()
+            image.save(buf, fmt, **opts)
+            write_atomic(path, [buf.getvalue()])
+        return os.path.getsize(path)
+
+    with Image.open(src_path) as im:
+        im.load()
+        if im.mode not in ("RGB", "RGBA"):
+            im = im.convert("RGBA" if "transparency" in im.info else "RGB")
+        widths = sorted({w for w in VARIANT_WIDTHS if w < im.width} | {im.width})
+        for mime, fmt, ext, opts in VARIANT_FORMATS:
+            if fmt not in Image.SAVE:
+                continue
+            for w in widths:
+                resized = im if w == im.width else im.resize((w, round(im.height * w / im.width)), Image.LANCZOS)
+                path = os.path.join(VARIANT_DIR, f"{sha256}-{w}.{ext}")
+                size = save(path, resized, fmt, **opts)
+                variants.append({"src": os.path.relpath(path, WEBROOT), "w": w, "type": mime, "bytes": size})
+        # Losslessly recompressed PNG, kept only if it actually beats the original
+        path = os.path.join(VARIANT_DIR, f"{sha256}.png")
+        size = save(path, im, "PNG", optimize=True)
+        if size < os.path.getsize(src_path):
+            variants.append({"src": os.path.relpath(path, WEBROOT), "w": im.width, "type": "image/png", "bytes": size})
+        else:
+            os.remove(path)
+    return variants
+
+def build_variants(entries):
+    """Attach "variants" to every entry that has an image, encoding in a process pool."""
+    entries = [e for e in entries if e.get("image")]
+    if not entries or not VARIANT_WIDTHS:
+        return {}
+    try:
+        import PIL  # noqa: F401
+    except ImportError:
+        print("  ⚠️  Pillow not installed — skipping responsive image variants")
+        return {}
+    for e in entries:
+        if "sha256" not in e:
+            e.update(file_digest(os.path.join(WEBROOT, e["image"])))
+
+    start = time.monotonic()
+    sources = {e["sha256"]: os.path.join(WEBROOT, e["image"]) for e in entries}
+    results = worker_map(encode_variants, {sha: (f"Variants for {path}", (path, sha)) for sha, path in sources.items()},
+                         VARIANT_WORKERS)
+    for e in entries:
+        if e["sha256"] in results:
+            e["variants"] = results[e["sha256"]]
+    print(f"🗜  Variants for {len(results)} images in {time.monotonic() - start:.1f}s")
+    return results
 
 # ─────────────────────────────────────────────────────────────
-# GENERATE GERMANY + WORLD CATEGORY IMAGES
+# PLACEHOLDERS  (inline LQIP + dominant colour per image)
+# Each shipped image gets a ~32px WebP preview as a data: URI
+# ("placeholder") and its dominant colour ("color") stored next to
+# "image", so the app can paint something before the real image
+# arrives. Previews are decoded in a thread pool (Pillow releases
+# the GIL), then the colours of the whole batch are found in one
+# pass with NumPy (most common 4-bit RGB bucket, averaged). Needs
+# Pillow; without NumPy the colour is the plain average.
 # ─────────────────────────────────────────────────────────────
-quiz_categories = {}
-for cat_key, items in CATEGORIES.items():
-    quiz_items = []
-    for item in items:
-        filename = f"{item['id']}.png"
-        out_path = os.path.join(OUT_DIR, filename)
-        if os.path.exists(out_path):
-            print(f"  ⏭  {filename} already exists, skipping")
-            quiz_items.append({"id": item["id"], "headline": item["headline"], "source": item["source"], "image": f"images/{filename}"})
+PLACEHOLDER_WIDTH   = int(os.environ.get("PLACEHOLDER_WIDTH", "32"))   # 0 = no placeholders
+PLACEHOLDER_QUALITY = 40
+
+def load_preview(src_path):
+    """Downscaled RGB copy of an image, PLACEHOLDER_WIDTH wide."""
+    from PIL import Image
+    with Image.open(src_path) as im:
+        im.draft("RGB", (PLACEHOLDER_WIDTH * 4, PLACEHOLDER_WIDTH * 4))   # JPEG: decode at reduced size
+        im = im.convert("RGB")
+        height = max(1, round(im.height * PLACEHOLDER_WIDTH / im.width))
+        return im.resize((PLACEHOLDER_WIDTH, height), Image.BOX)
+
+def dominant_colors(previews):
+    """"#rrggbb" per preview: mean of the pixels in its most common 4-bit/channel bucket."""
+    if np is None:
+        from PIL import Image
+        return ["#%02x%02x%02x" % im.resize((1, 1), Image.BOX).getpixel((0, 0)) for im in previews]
+    pixels = [np.asarray(im, dtype=np.uint8).reshape(-1, 3) for im in previews]
+    owner = np.repeat(np.arange(len(pixels)), [len(p) for p in pixels])
+    rgb = np.concatenate(pixels).astype(np.int64)
+    bucket = owner * 4096 + ((rgb[:, 0] >> 4) << 8 | (rgb[:, 1] >> 4) << 4 | rgb[:, 2] >> 4)
+    counts = np.bincount(bucket, minlength=len(pixels) * 4096).reshape(len(pixels), 4096)
+    best = counts.argmax(axis=1) + np.arange(len(pixels)) * 4096
+    in_best = bucket == best[owner]
+    sums = np.stack([np.bincount(owner[in_best], weights=rgb[in_best, c], minlength=len(pixels))
+                     for c in range(3)], axis=1)
+    mean = np.rint(sums / counts.max(axis=1)[:, None]).astype(int)
+    return ["#%02x%02x%02x" % tuple(c) for c in mean]
+
+def build_placeholders(entries):
+    """Attach "placeholder" + "color" to every entry with an image; returns {sha256: {...}}."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    entries = [e for e in entries if e.get("image") and os.path.exists(os.path.join(WEBROOT, e["image"]))]
+    if not entries or not PLACEHOLDER_WIDTH:
+        return {}
+    try:
+        from PIL import Image
+    except ImportError:
+        print("  ⚠️  Pillow not installed — skipping image placeholders")
+        return {}
+    for e in entries:
+        if "sha256" not in e:
+            e.update(file_digest(os.path.join(WEBROOT, e["image"])))
+
+    start = time.monotonic()
+    sources = {e["sha256"]: os.path.join(WEBROOT, e["image"]) for e in entries}
+    previews = {}
+    with ThreadPoolExecutor(max_workers=max(1, VARIANT_WORKERS)) as pool:
+        futures = {sha: pool.submit(load_preview, path) for sha, path in sources.items()}
+        for sha, fut in futures.items():
+            try:
+                previews[sha] = fut.result()
+            except Exception as ex:
+                print(f"  ⚠️  Placeholder failed for {sources[sha]}: {ex}")
+    Image.init()
+    fmt, mime = ("WEBP", "image/webp") if "WEBP" in Image.SAVE else ("JPEG", "image/jpeg")
+    results = {}
+    for (sha, im), color in zip(previews.items(), dominant_colors(list(previews.values()))):
+        buf = io.BytesIO()
+        im.save(buf, fmt, quality=PLACEHOLDER_QUALITY)
+        results[sha] = {"placeholder": f"data:{mime};base64,{base64.b64encode(buf.getvalue()).decode()}",
+                        "color": color}
+    for e in entries:
+        if e["sha256"] in results:
+            e.update(results[e["sha256"]])
+    if results:
+        size = sum(len(r["placeholder"]) for r in results.values()) // len(results)
+        print(f"🌫  Placeholders for {len(results)} images (~{size} bytes each) in {time.monotonic() - start:.1f}s")
+    return results
+
+def backfill_placeholders():
+    """Add placeholders to quiz-data.json and every archived day (refreshing its pack + summary)."""
+    import glob
+    for path in [JSON_PATH] + sorted(glob.glob(os.path.join(WEBROOT, "quiz-data-*.json"))):
+        if not os.path.exists(path):
+            continue
+        with open(path) as f:
+            quiz = json.load(f)
+        entries = [e for e in quiz_image_entries(quiz) if "placeholder" not in e]
+        if not entries:
             continue
-        print(f"\n🖼  [{cat_key.upper()} via Replicate/Flux] {item['headline'][:55]}...")
+        print(f"\n🌫  {os.path.basename(path)}: {len(entries)} images")
+        build_placeholders(entries)
+        write_public_json(path, quiz)
+        if path != JSON_PATH:
+            day = quiz["date"]
+            if os.path.exists(pack_path(day)):
+                write_day_pack(day, quiz)
+            update_archive_summary(day, quiz)
+
+# ─────────────────────────────────────────────────────────────
+# PUBLISHED JSON  (minified + precompressed .gz / .br siblings)
+# nginx gzip_static / brotli_static can serve the siblings as-is.
+# Output is byte-for-byte reproducible (gzip mtime=0, fixed levels)
+# and unchanged files are not rewritten, so ETags stay stable.
+# Brotli needs `pip install brotli`; without it no .br is written.
+# ─────────────────────────────────────────────────────────────
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+def write_precompressed(path, data):
+    """Write data to path plus .gz (and .br) siblings, skipping files that are unchanged."""
+    outputs = {path + ".gz": gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli:
+        outputs[path + ".br"] = brotli.compress(data, quality=11)
+    elif os.path.exists(path + ".br"):
+        os.remove(path + ".br")   # a stale .br would shadow the new JSON
+    outputs[path] = data          # siblings first, the plain file last
+    for out_path, blob in outputs.items():
+        if os.path.exists(out_path) and os.path.getsize(out_path) == len(blob):
+            with open(out_path, "rb") as f:
+                if f.read() == blob:
+                    continue
+        write_atomic(out_path, [blob])
+
+def write_public_json(path, obj):
+    """Minified JSON for the web (quiz-data*.json, archive-index.json)."""
+    write_precompressed(path, json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode())
+
+def precompress_file(path):
+    """Refresh the .gz/.br siblings of a file that was changed in place."""
+    with open(path, "rb") as f:
+        write_precompressed(path, f.read())
+
+# ─────────────────────────────────────────────────────────────
+# ARCHIVE STORE  (content-addressed blobs + per-day manifests)
+# Archived images live once under images/blobs/ab/<sha256>.png,
+# hardlinked rather than copied. Each day gets a checksum manifest,
+# and a blob is only deleted once no manifest references it.
+# ─────────────────────────────────────────────────────────────
+BLOB_DIR      = os.path.join(OUT_DIR, "blobs")
+MANIFEST_DIR  = os.path.join(OUT_DIR, "manifests")
+REFCOUNT_PATH = os.path.join(BLOB_DIR, "refcounts.json")
+
+def write_json_atomic(path, obj, **dump_kw):
+    data = json.dumps(obj, **dump_kw).encode()
+    return write_atomic(path, [data])
+
+def append_json_list(path, value):
+    """Append one value to a JSON list file in place, without rewriting it."""
+    item = json.dumps(value, ensure_ascii=False).encode()
+    if not os.path.exists(path) or not os.path.getsize(path):
+        write_public_json(path, [value])
+        return
+    with open(path, "r+b") as f:
+        pos = f.seek(0, os.SEEK_END)
+        while pos > 0:   # find the closing bracket (skipping trailing whitespace)
+            pos -= 1
+            f.seek(pos)
+            char = f.read(1)
+            if char == b"]":
+                break
+            if not char.isspace():
+                raise ValueError(f"{path} is not a JSON list")
+        else:
+            raise ValueError(f"{path} is not a JSON list")
+        prev = pos
+        while prev > 0:   # is the list empty?
+            prev -= 1
+            f.seek(prev)
+            char = f.read(1)
+            if not char.isspace():
+                break
+        f.seek(pos)
+        f.truncate()
+        f.write((b"" if char == b"[" else b",") + item + b"]")
+        f.flush()
+        os.fsync(f.fileno())
+    precompress_file(path)
+
+def quiz_image_entries(quiz):
+    """Every dict with an "image" in a quiz-data document (categories, collages, OTD)."""
+    for items in quiz.get("categories", {}).values():
+        yield from items
+    for styles in quiz.get("collages", {}).values():
+        yield from styles.values()
+    if quiz.get("onthisday"):
+        yield from quiz["onthisday"].get("events", [])
+
+def blob_path(sha256, ext=".png"):
+    return os.path.join(BLOB_DIR, sha256[:2], f"{sha256}{ext}")
+
+def store_blob(src):
+    """Hardlink src into the blob store (copy only across filesystems).
+    Safe because image writes always replace files, never modify them in place."""
+    digest = file_digest(src)
+    dst = blob_path(digest["sha256"], os.path.splitext(src)[1])
+    if not os.path.exists(dst):
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
         try:
-            image_path = generate_image_replicate(item["prompt"], filename)
-            quiz_items.append({"id": item["id"], "headline": item["headline"], "source": item["source"], "image": image_path})
-        except Exception as e:
-            print(f"  ❌ Error: {e}")
-    quiz_categories[cat_key] = quiz_items
+            os.link(src, dst)
+        except OSError:
+            with open(src, "rb") as f:
+                write_atomic(dst, iter_chunks(f))
+    return digest, dst
+
+def load_refcounts():
+    if os.path.exists(REFCOUNT_PATH):
+        with open(REFCOUNT_PATH) as f:
+            return json.load(f)
+    # First run (or lost file): rebuild from the manifests once
+    refcounts = {}
+    if os.path.isdir(MANIFEST_DIR):
+        for name in os.listdir(MANIFEST_DIR):
+            with open(os.path.join(MANIFEST_DIR, name)) as f:
+                for info in json.load(f)["files"].values():
+                    refcounts[info["blob"]] = refcounts.get(info["blob"], 0) + 1
+    return refcounts
+
+def archive_day(day, quiz):
+    """Store a day's images as blobs, relink `quiz` to them and write its manifest.
+    Blobs whose refcount drops to zero (re-archived day) are garbage-collected."""
+    files = {}
+    for entry in quiz_image_entries(quiz):
+        src = os.path.join(WEBROOT, entry["image"])
+        if not os.path.exists(src):
+            continue
+        digest, dst = store_blob(src)
+        rel = os.path.relpath(dst, WEBROOT)
+        files[os.path.basename(entry["image"])] = {"blob": rel, **digest}
+        entry.update(image=rel, **digest)
+
+    os.makedirs(MANIFEST_DIR, exist_ok=True)
+    manifest_path = os.path.join(MANIFEST_DIR, f"{day}.json")
+    refcounts = load_refcounts()
+    released = []
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            released = [info["blob"] for info in json.load(f)["files"].values()]
+    for rel in released:
+        refcounts[rel] = refcounts.get(rel, 1) - 1
+    for info in files.values():
+        refcounts[info["blob"]] = refcounts.get(info["blob"], 0) + 1
+
+    manifest = {"date": day, "files": files}
+    write_json_atomic(manifest_path, manifest, indent=1, sort_keys=True)
+    for rel in released:
+        if refcounts.get(rel, 0) <= 0:
+            refcounts.pop(rel, None)
+            if os.path.exists(os.path.join(WEBROOT, rel)):
+                os.remove(os.path.join(WEBROOT, rel))
+    os.makedirs(BLOB_DIR, exist_ok=True)
+    write_json_atomic(REFCOUNT_PATH, refcounts, sort_keys=True)
+    return manifest
+
+def backfill_variants():
+    """Add responsive variants to today's quiz-data.json and every archived quiz-data-*.json."""
+    import glob
+    for path in [JSON_PATH] + sorted(glob.glob(os.path.join(WEBROOT, "quiz-data-*.json"))):
+        if not os.path.exists(path):
+            continue
+        with open(path) as f:
+            quiz = json.load(f)
+        entries = [e for e in quiz_image_entries(quiz)
+                   if e.get("image") and os.path.exists(os.path.join(WEBROOT, e["image"]))]
+        print(f"\n🗜  {os.path.basename(path)}: {len(entries)} images")
+        build_variants(entries)
+        write_public_json(path, quiz)
 
 # ─────────────────────────────────────────────────────────────
-# GENERATE HISTORY CATEGORY IMAGES
-# Seed by date so same day always gives same events + styles
+# DAY PACKS  (one file per archived day: quiz JSON + its images)
+# Replaying an archived day is then one request instead of 15+.
+# Layout of packs/quiz-YYYY-MM-DD.pack:
+#   "QUIZPK01" | uint32 LE header length | header JSON | data
+# The header maps "quiz" and every image path used in the quiz JSON
+# to {offset, length, type, sha256}, offsets counted from the start
+# of the data section, so a client can read it with one streaming
+# fetch or with Range requests (first 12 bytes → header → parts).
+# Images are packed as their PACK_IMAGE_WIDTH WebP variant when
+# there is one, else as the original.
 # ─────────────────────────────────────────────────────────────
-date_seed = int(hashlib.md5(today.encode()).hexdigest(), 16) % (2**32)
-rng = random.Random(date_seed)
+PACK_DIR   = os.path.join(WEBROOT, "packs")
+PACK_MAGIC = b"QUIZPK01"
+PACK_WIDTH = int(os.environ.get("PACK_IMAGE_WIDTH", "640"))   # 0 = always pack the originals
 
-# Pick 8 events: first 4 get images, next 4 are distractors (decoys)
-shuffled_events = rng.sample(HISTORICAL_EVENTS, min(8, len(HISTORICAL_EVENTS)))
-history_main       = shuffled_events[:4]
-history_distractors = shuffled_events[4:8]
+def pack_path(day):
+    return os.path.join(PACK_DIR, f"quiz-{day}.pack")
 
-history_items = []
-for i, event in enumerate(history_main):
-    style = rng.choice(ART_STYLES)
-    filename = f"hi{i+1}.png"
-    out_path = os.path.join(OUT_DIR, filename)
-    if os.path.exists(out_path):
-        print(f"  ⏭  {filename} already exists, skipping")
-        # Reconstruct metadata (style may differ if script re-runs after a crash)
-        # Use stored quiz-data.json if available, else best-effort
-        history_items.append({
-            "id": f"hi{i+1}", "headline": event["headline"],
-            "year": event["year"], "source": "Historical Record",
-            "style": style["name"], "image": f"images/{filename}"
-        })
-        continue
-    full_prompt = f"{event['prompt_base']}, {style['suffix']}, highly detailed, award-winning composition"
-    print(f"\n🏛️  [HISTORY via Replicate/Flux] {event['headline'][:50]}... [{style['name']}]")
+def pack_source(entry):
+    """(path under WEBROOT, mime type) of the file packed for a quiz item."""
+    webp = [v for v in entry.get("variants", []) if v["type"] == "image/webp" and v["w"] <= PACK_WIDTH]
+    if webp:
+        best = max(webp, key=lambda v: v["w"])
+        if os.path.exists(os.path.join(WEBROOT, best["src"])):
+            return best["src"], "image/webp"
+    return entry["image"], "image/png"
+
+def write_day_pack(day, quiz):
+    """Write (or replace) a day's pack from its archived quiz document."""
+    quiz_bytes = json.dumps(quiz, ensure_ascii=False, separators=(",", ":")).encode()
+    header = {"date": day, "quiz": {"offset": 0, "length": len(quiz_bytes)}, "files": {}}
+    sources, offset = [], len(quiz_bytes)
+    for entry in quiz_image_entries(quiz):
+        if entry["image"] in header["files"]:
+            continue
+        rel, mime = pack_source(entry)
+        path = os.path.join(WEBROOT, rel)
+        if not os.path.exists(path):
+            continue
+        digest = file_digest(path)
+        header["files"][entry["image"]] = {"offset": offset, "length": digest["bytes"],
+                                           "type": mime, "sha256": digest["sha256"]}
+        sources.append(path)
+        offset += digest["bytes"]
+    header_bytes = json.dumps(header, separators=(",", ":")).encode()
+
+    def chunks():
+        yield PACK_MAGIC + struct.pack("<I", len(header_bytes)) + header_bytes
+        yield quiz_bytes
+        for path in sources:
+            with open(path, "rb") as f:
+                yield from iter_chunks(f)
+
+    os.makedirs(PACK_DIR, exist_ok=True)
+    written = write_atomic(pack_path(day), chunks())
+    print(f"📦 Pack {os.path.basename(pack_path(day))}: {len(sources)} images, {written['bytes'] // 1024}KB")
+    return written
+
+@contextlib.contextmanager
+def read_pack(path):
+    """mmap a pack; yields (header, data) where data is a zero-copy memoryview of the data section."""
+    with open(path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(mm)
     try:
-        image_path = generate_image_replicate(full_prompt, filename)
-        history_items.append({
-            "id": f"hi{i+1}", "headline": event["headline"],
-            "year": event["year"], "source": "Historical Record",
-            "style": style["name"], "image": image_path
-        })
-    except Exception as e:
-        print(f"  ❌ Error: {e}")
+        if view[:8] != PACK_MAGIC:
+            raise ValueError(f"{path} is not a day pack")
+        (size,) = struct.unpack_from("<I", mm, 8)
+        data = view[12 + size:]
+        try:
+            yield json.loads(bytes(view[12:12 + size])), data
+        finally:
+            data.release()
+    finally:
+        view.release()
+        mm.close()
 
-history_distractor_items = [
-    {"id": f"hd{i+1}", "headline": ev["headline"],
-     "year": ev["year"], "source": "Historical Record"}
-    for i, ev in enumerate(history_distractors)
-]
-quiz_categories["history"] = history_items
+def verify_pack(path):
+    """Problems found in a pack (empty list = sound): checksums, quiz JSON, missing images."""
+    problems = []
+    with read_pack(path) as (header, data):
+        end = header["quiz"]["offset"] + header["quiz"]["length"]
+        quiz = json.loads(bytes(data[header["quiz"]["offset"]:end]))
+        if quiz.get("date") != header["date"]:
+            problems.append(f"quiz date {quiz.get('date')} != pack date {header['date']}")
+        for name, part in header["files"].items():
+            end = part["offset"] + part["length"]
+            if end > len(data):
+                problems.append(f"{name}: truncated")
+            elif hashlib.sha256(data[part["offset"]:end]).hexdigest() != part["sha256"]:
+                problems.append(f"{name}: checksum mismatch")
+        for entry in quiz_image_entries(quiz):
+            if entry.get("image") and entry["image"] not in header["files"]:
+                problems.append(f"{entry['image']}: not in pack")
+    return problems
+
+def backfill_packs():
+    """Write packs for archived days that don't have one yet."""
+    import glob
+    for path in sorted(glob.glob(os.path.join(WEBROOT, "quiz-data-*.json"))):
+        day = os.path.basename(path)[len("quiz-data-"):-len(".json")]
+        if not os.path.exists(pack_path(day)):
+            with open(path) as f:
+                write_day_pack(day, json.load(f))
+
+def verify_packs():
+    """Check every pack; returns the number of bad ones."""
+    import glob
+    bad = 0
+    for path in sorted(glob.glob(os.path.join(PACK_DIR, "quiz-*.pack"))):
+        try:
+            problems = verify_pack(path)
+        except (OSError, ValueError) as e:
+            problems = [str(e)]
+        if problems:
+            bad += 1
+            print(f"❌ {os.path.basename(path)}: " + "; ".join(problems))
+        else:
+            print(f"✅ {os.path.basename(path)}")
+    return bad
 
 # ─────────────────────────────────────────────────────────────
-# GENERATE "ON THIS DAY" IMAGES (Wikipedia API)
+# ARCHIVE SUMMARY  (archive/YYYY-MM.json, one page per month)
+# Per-day metadata for the archive screen: modes and question
+# counts, styles, a small thumbnail per mode and the checksums of
+# the day's JSON and pack. Archiving a day rewrites only its month's
+# page; pages link to the previous month ("prev") and
+# archive/months.json is an append-only list of all pages.
 # ─────────────────────────────────────────────────────────────
-def fetch_onthisday_events():
-    """Fetch events from Wikipedia's On This Day API for today's date."""
-    month = datetime.date.today().month
-    day = datetime.date.today().day
-    url = f"https://api.wikimedia.org/feed/v1/wikipedia/en/onthisday/events/{month:02d}/{day:02d}"
-    
-    req = urllib.request.Request(url, headers={
-        'User-Agent': 'AINewsQuizBot/1.0 (OpenClaw; shelldon@professionalcrastination.de)'
-    })
+SUMMARY_DIR    = os.path.join(WEBROOT, "archive")
+SUMMARY_MONTHS = os.path.join(SUMMARY_DIR, "months.json")
+
+def summary_page_path(month):
+    return os.path.join(SUMMARY_DIR, f"{month}.json")
+
+def thumb_source(entry):
+    """Smallest WebP variant of an item (the original if it has none)."""
+    webp = [v for v in entry.get("variants", []) if v["type"] == "image/webp"]
+    return min(webp, key=lambda v: v["w"])["src"] if webp else entry["image"]
+
+def day_summary(day, quiz):
+    """Archive-screen metadata for one archived day."""
+    modes, thumbs = {}, {}
+    for name, items in quiz.get("categories", {}).items():
+        if items:
+            modes[name] = len(items)
+            thumbs[name] = thumb_source(items[0])
+    events = (quiz.get("onthisday") or {}).get("events", [])
+    if events:
+        modes["onthisday"] = len(events)
+        thumbs["onthisday"] = thumb_source(events[0])
+    collages = {topic: sorted(styles) for topic, styles in quiz.get("collages", {}).items() if styles}
+    if collages:
+        modes["collages"] = sum(len(styles) for styles in collages.values())
+        first = next(iter(quiz["collages"].values()))
+        thumbs["collages"] = thumb_source(next(iter(first.values())))
+    summary = {"date": day, "modes": modes, "questions": sum(modes.values()), "collages": collages,
+               "styles": sorted({e["style"] for e in quiz_image_entries(quiz) if e.get("style")}),
+               "thumbs": thumbs}
+    for key, path in (("json", os.path.join(WEBROOT, f"quiz-data-{day}.json")), ("pack", pack_path(day))):
+        if os.path.exists(path):
+            summary[key] = file_digest(path)
+    return summary
+
+def list_summary_months():
+    if not os.path.exists(SUMMARY_MONTHS):
+        return []
+    with open(SUMMARY_MONTHS) as f:
+        return json.load(f)
+
+def update_archive_summary(day, quiz):
+    """Add (or refresh) a day on its month's page; a new page is linked to the latest older one."""
+    month = day[:7]
+    path = summary_page_path(month)
+    if os.path.exists(path):
+        with open(path) as f:
+            page = json.load(f)
+        new_page = False
+    else:
+        older = [m for m in list_summary_months() if m < month]
+        page = {"month": month, "prev": max(older) if older else None, "days": {}}
+        new_page = True
+    page["days"][day] = day_summary(day, quiz)
+    page["days"] = dict(sorted(page["days"].items(), reverse=True))   # newest first
+    os.makedirs(SUMMARY_DIR, exist_ok=True)
+    write_public_json(path, page)
+    if new_page:
+        append_json_list(SUMMARY_MONTHS, month)
+
+def rebuild_archive_summary():
+    """Rewrite every summary page from the archived quiz-data-*.json files."""
+    import glob
+    pages = {}
+    for path in sorted(glob.glob(os.path.join(WEBROOT, "quiz-data-*.json"))):
+        day = os.path.basename(path)[len("quiz-data-"):-len(".json")]
+        with open(path) as f:
+            pages.setdefault(day[:7], {})[day] = day_summary(day, json.load(f))
+    os.makedirs(SUMMARY_DIR, exist_ok=True)
+    prev = None
+    for month in sorted(pages):
+        days = dict(sorted(pages[month].items(), reverse=True))
+        write_public_json(summary_page_path(month), {"month": month, "prev": prev, "days": days})
+        print(f"🗂️  archive/{month}.json: {len(days)} days")
+        prev = month
+    write_public_json(SUMMARY_MONTHS, sorted(pages))
+
+# ─────────────────────────────────────────────────────────────
+# STAGE GRAPH  (fingerprinted stages, selective re-runs)
+# Each stage declares its inputs (prompts, pool entries, date
+# seed, upstream outputs). A stage only runs again when their
+# fingerprint changed or its outputs are gone from disk; otherwise
+# its output is reused from the build state of the last run.
+# ─────────────────────────────────────────────────────────────
+STATE_DIR        = os.environ.get("QUIZ_STATE_DIR", os.path.expanduser("~/.cache/ai-news-quiz"))
+BUILD_STATE_PATH = os.path.join(STATE_DIR, "build-state.json")
+STAGE_NAMES      = ["archive", "news", "history", "otd-fetch", "otd", "collages", "variants", "placeholders"]
+BUILD_STATE      = {"stages": {}, "images": {}}   # images: filename → hash of the prompt it shows
+STAGE_TIMES      = {}   # wall seconds per stage this run, kept as BUILD_STATE["timings"]
+
+def load_build_state():
+    if os.path.exists(BUILD_STATE_PATH):
+        try:
+            with open(BUILD_STATE_PATH) as f:
+                BUILD_STATE.update(json.load(f))
+        except (OSError, ValueError) as e:
+            print(f"⚠️  Ignoring unreadable build state: {e}")
+
+def save_build_state():
+    os.makedirs(STATE_DIR, exist_ok=True)
+    write_json_atomic(BUILD_STATE_PATH, BUILD_STATE, ensure_ascii=False)
+
+def fingerprint(inputs):
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+def output_intact(output):
+    """True if every image referenced by a stage output was generated and is still on disk."""
+    if isinstance(output, dict):
+        for key, value in output.items():
+            if key in ("image", "src") and (not value or not os.path.exists(os.path.join(WEBROOT, value))):
+                return False
+            if isinstance(value, (dict, list)) and not output_intact(value):
+                return False
+    elif isinstance(output, list):
+        return all(output_intact(v) for v in output)
+    return True
+
+def run_stage(name, inputs, build):
+    """Return build(force)'s output, or the last run's output if the stage can be skipped.
+    --only limits which stages may run; --rebuild forces a stage regardless of inputs."""
+    fp = fingerprint(inputs)
+    prev = BUILD_STATE["stages"].get(name)
+    force = name in args.rebuild
+    if args.only and name not in args.only and not force:
+        print(f"⏭  [{name}] not selected{', reusing last output' if prev else ''}")
+        if prev and not output_intact(prev["output"]):
+            print(f"  ⚠️  [{name}] last output has missing images — run it to regenerate them")
+        return prev["output"] if prev else None
+    if not force and prev and prev["fingerprint"] == fp and output_intact(prev["output"]):
+        print(f"⏭  [{name}] inputs unchanged, reusing last output")
+        return prev["output"]
+    print(f"\n▶️  [{name}]{' (rebuild)' if force else ''}")
+    start = time.monotonic()
+    METRICS["stage"] = name
+    with span(name, "stage"):
+        output = build(force)
+    METRICS["stage"] = None
+    STAGE_TIMES[name] = round(time.monotonic() - start, 3)
+    BUILD_STATE["stages"][name] = {"fingerprint": fp, "output": output}
+    return output
+
+# ─────────────────────────────────────────────────────────────
+# RUN JOURNAL  (deterministic crash-resume)
+# Before any image API call, every planned job of the day (event id,
+# style id, prompt hash, output path) and the On This Day selection
+# are written to journal-YYYY-MM-DD.json; each job's status is then
+# updated as soon as it finishes. A re-run after a crash replays the
+# journal: same selection, and only unfinished jobs are submitted
+# (in-flight Replicate predictions are polled, not paid for twice).
+# ─────────────────────────────────────────────────────────────
+JOURNAL      = {"date": "", "jobs": {}}
+JOURNAL_LOCK = threading.RLock()
+JOURNAL_DIR  = STATE_DIR   # a pre-rendered day keeps its journal in its staging folder
+
+def journal_path(day):
+    return os.path.join(JOURNAL_DIR, f"journal-{day}.json")
+
+def load_journal(day):
+    """Load (or start) the journal for `day`; journals of past days are removed."""
+    JOURNAL.clear()
+    JOURNAL.update({"date": day, "jobs": {}})
+    path = journal_path(day)
+    if os.path.exists(path):
+        try:
+            with open(path) as f:
+                JOURNAL.update(json.load(f))
+            done = sum(1 for j in JOURNAL["jobs"].values() if j.get("status") == "done")
+            print(f"↩️  Resuming from journal: {done}/{len(JOURNAL['jobs'])} jobs already done")
+        except (OSError, ValueError) as e:
+            print(f"⚠️  Ignoring unreadable journal: {e}")
+    for filename, job in JOURNAL["jobs"].items():
+        if job.get("status") == "done" and job.get("prompt_hash"):
+            BUILD_STATE["images"][filename] = job["prompt_hash"]
+    if os.path.isdir(JOURNAL_DIR):
+        for name in os.listdir(JOURNAL_DIR):
+            if name.startswith("journal-") and name < os.path.basename(path):
+                os.remove(os.path.join(JOURNAL_DIR, name))
+
+def save_journal():
+    with JOURNAL_LOCK:
+        os.makedirs(JOURNAL_DIR, exist_ok=True)
+        write_json_atomic(journal_path(JOURNAL["date"]), JOURNAL, ensure_ascii=False)
+
+def journal_plan(name, plan):
+    """Return the selection journaled as `name` today, or journal `plan` and return it."""
+    with JOURNAL_LOCK:
+        if name not in JOURNAL:
+            JOURNAL[name] = plan
+            save_journal()
+        return JOURNAL[name]
+
+def journal_job(filename, **fields):
+    with JOURNAL_LOCK:
+        JOURNAL["jobs"].setdefault(filename, {}).update(fields)
+        save_journal()
+
+# ─────────────────────────────────────────────────────────────
+# "ON THIS DAY" STORE  (all 366 dates, ranked ahead of time)
+# One small JSON per MM-DD with the trimmed feed, its ETag /
+# Last-Modified and the precomputed 4 main + 4 distractor pick.
+# `--refresh-otd-store` fills/revalidates all dates in bulk (cron it
+# monthly) and --prerender-days revalidates the dates it stages; the
+# daily run is a local lookup that only fetches a date not stored yet.
+# ─────────────────────────────────────────────────────────────
+OTD_STORE_DIR         = os.environ.get("OTD_STORE_DIR", os.path.join(STATE_DIR, "onthisday"))
+OTD_STORE_MAX_DAYS    = float(os.environ.get("OTD_STORE_MAX_DAYS", "31"))  # prerender revalidates older entries
+OTD_STORE_CONCURRENCY = int(os.environ.get("OTD_STORE_CONCURRENCY", "4"))  # bulk refresh, be polite
+
+def fetch_onthisday_events(month, day, etag=None, last_modified=None):
+    """Fetch one date's events from Wikipedia's On This Day API (conditional GET).
+    Returns (events, etag, last_modified), or None if the stored copy is still current."""
+    url = f"{WIKIMEDIA_API_BASE}/feed/v1/wikipedia/en/onthisday/events/{month:02d}/{day:02d}"
+    headers = {'User-Agent': 'AINewsQuizBot/1.0 (OpenClaw; shelldon@professionalcrastination.de)'}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
     
-    with urllib.request.urlopen(req, timeout=15) as resp:
-        data = json.loads(resp.read())
+    with http_request("GET", url, headers=headers, timeout=15, gzip=HTTP_GZIP,
+                      metric=("wikimedia", "onthisday")) as resp:
+        if resp.status == 304:
+            return None
+        raw = resp.read()
+    with span("json decode", "cpu", bytes=len(raw)):
+        data = json.loads(raw)
     
-    return data['events']
+    return data['events'], resp.headers.get("ETag"), resp.headers.get("Last-Modified")
 
-def select_otd_events(events):
+OTD_MIN_YEAR = 500    # events outside this range are never picked
+OTD_MAX_YEAR = 2020
+# Visual/historical keywords → weight in an event's score;
+# OTD_KEYWORD_WEIGHTS='{"battle": 2, "born": 0}' adjusts or adds some
+OTD_KEYWORD_WEIGHTS = {kw: 1 for kw in [
+    'emperor', 'king', 'queen', 'war', 'battle', 'discovered', 'founded',
+    'independence', 'revolution', 'treaty', 'expedition', 'crowned',
+    'built', 'conquest', 'marines', 'landing', 'attack', 'invasion',
+    'signed', 'declared', 'assassinated', 'born', 'died']}
+OTD_KEYWORD_WEIGHTS.update({kw.lower(): w for kw, w in json.loads(os.environ.get("OTD_KEYWORD_WEIGHTS", "{}")).items()})
+OTD_KEYWORDS = tuple((kw, w) for kw, w in OTD_KEYWORD_WEIGHTS.items() if w)
+
+def otd_score(text):
+    """Sum of the weights of the keywords in text (substring match, case-insensitive)."""
+    # Lowercase once; `in` on str is a C-speed scan, faster than re alternation here
+    lowered = text.lower()
+    return sum(w for kw, w in OTD_KEYWORDS if kw in lowered)
+
+def select_otd_events(events, main=4, total=8):
     """Select 4 main + 4 distractor events with visual potential."""
-    # Filter for events 500-2020 with pages/thumbnails
-    interesting = []
-    for evt in events:
-        year = evt.get('year', 0)
-        text = evt.get('text', '')
-        pages = evt.get('pages', [])
-        
-        if 500 <= year <= 2020 and len(pages) > 0:
-            # Score based on visual/historical keywords
-            keywords = ['emperor', 'king', 'queen', 'war', 'battle', 'discovered', 'founded',
-                       'independence', 'revolution', 'treaty', 'expedition', 'crowned',
-                       'built', 'conquest', 'marines', 'landing', 'attack', 'invasion',
-                       'signed', 'declared', 'assassinated', 'born', 'died']
-            score = sum(1 for kw in keywords if kw.lower() in text.lower())
-            interesting.append({
-                'year': year,
-                'text': text,
-                'pages': pages,
-                'score': score
-            })
+    # Filter for events 500-2020 with pages/thumbnails, then rank by keyword score and
+    # year (oldest first); the -i keeps feed order on ties, like a stable sort would
+    ranked = sorted(((otd_score(evt.get('text', '')), -evt.get('year', 0), -i)
+                     for i, evt in enumerate(events)
+                     if OTD_MIN_YEAR <= evt.get('year', 0) <= OTD_MAX_YEAR and evt.get('pages')),
+                    reverse=True)
     
-    # Sort by score and year (prefer diverse time periods)
-    interesting.sort(key=lambda x: (x['score'], -x['year']), reverse=True)
-    
-    # Select 8 events spread across centuries
-    selected = []
+    # Select 8 events spread across centuries (picks are positions in `ranked`)
+    picked = []
     used_centuries = set()
     
-    for evt in interesting:
-        century = evt['year'] // 100
-        if century not in used_centuries or len(selected) >= 4:
-            selected.append(evt)
+    for pos, (score, neg_year, _) in enumerate(ranked):
+        century = -neg_year // 100
+        if century not in used_centuries or len(picked) >= main:
+            picked.append(pos)
             used_centuries.add(century)
-            if len(selected) == 8:
+            if len(picked) == total:
                 break
     
     # If we need more, add highest-scoring remaining
-    if len(selected) < 8:
-        for evt in interesting:
-            if evt not in selected:
-                selected.append(evt)
-                if len(selected) == 8:
-                    break
+    if len(picked) < total:
+        chosen = set(picked)
+        picked += [pos for pos in range(len(ranked)) if pos not in chosen][:total - len(picked)]
     
-    return selected[:4], selected[4:8]  # (main, distractors)
+    selected = []
+    for pos in picked:
+        score, _, neg_i = ranked[pos]
+        evt = events[-neg_i]
+        selected.append({'year': evt.get('year', 0), 'text': evt.get('text', ''),
+                         'pages': evt['pages'], 'score': score})
+    return selected[:main], selected[main:total]  # (main, distractors)
 
 def create_otd_prompt(text, year):
     """Create an AI image prompt from Wikipedia event text."""
@@ -700,100 +2636,825 @@ def create_otd_prompt(text, year):
     
     return prompt
 
-# Generate On This Day quiz data
-otd_items = []
-otd_distractor_items = []
+def rank_otd_events(events):
+    """Trim a feed to what selection needs and precompute the day's pick."""
+    trimmed = [{"year": evt.get("year", 0), "text": evt.get("text", ""),
+                "pages": [{"title": page.get("title", "")} for page in evt.get("pages", [])]}
+               for evt in events]
+    main, distractors = select_otd_events(trimmed)
+    # Decoys close to the main events in era/theme beat the next 4 by keyword score
+    distractors = similar_otd_distractors(trimmed, main) or distractors
+    return {"events": trimmed, "main": main, "distractors": distractors}
+
+def otd_store_path(month_day):
+    return os.path.join(OTD_STORE_DIR, f"{month_day}.json")
+
+def otd_store_get(month_day):
+    try:
+        with open(otd_store_path(month_day)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def otd_store_refresh(month_day):
+    """Revalidate one date against the feed and re-rank it. Returns (entry, changed)."""
+    entry = otd_store_get(month_day) or {}
+    month, day = map(int, month_day.split("-"))
+    fetched = fetch_onthisday_events(month, day, entry.get("etag"), entry.get("last_modified"))
+    now = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds")
+    if fetched is None:
+        entry.update(rank_otd_events(entry["events"]), checked=now)   # re-rank with current rules
+    else:
+        events, etag, last_modified = fetched
+        entry = {"month_day": month_day, "etag": etag, "last_modified": last_modified,
+                 "checked": now, **rank_otd_events(events)}
+    os.makedirs(OTD_STORE_DIR, exist_ok=True)
+    write_json_atomic(otd_store_path(month_day), entry, ensure_ascii=False)
+    return entry, fetched is not None
+
+def otd_store_lookup(month_day, revalidate=False, max_age_days=None):
+    """A date's ranked events from the store, however old; only a missing entry is fetched.
+    `revalidate`, or an entry older than `max_age_days`, is refreshed first, and the stored
+    copy is still used if the feed is slow or down."""
+    entry = otd_store_get(month_day)
+    if entry and not revalidate:
+        age = datetime.datetime.now(datetime.timezone.utc) - datetime.datetime.fromisoformat(entry["checked"])
+        if max_age_days is None or age.total_seconds() < max_age_days * 86400:
+            return entry
+    try:
+        return otd_store_refresh(month_day)[0]
+    except Exception as e:
+        if not entry:
+            raise
+        print(f"   ⚠️  'On This Day' feed unavailable ({e}), using stored events from {entry['checked'][:10]}")
+        return entry
+
+def otd_ranked(month_day, revalidate=False, max_age_days=None):
+    """Just a date's precomputed pick (+ feed size), as kept in the build state."""
+    entry = otd_store_lookup(month_day, revalidate, max_age_days)
+    return {"events": len(entry["events"]), "main": entry["main"], "distractors": entry["distractors"]}
+
+def refresh_otd_store():
+    """Fill or revalidate the store for all 366 dates (conditional requests)."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    leap_year = datetime.date(2024, 1, 1)
+    dates = [(leap_year + datetime.timedelta(days=n)).strftime("%m-%d") for n in range(366)]
+    counts, lock = {"updated": 0, "unchanged": 0, "failed": 0}, threading.Lock()
+
+    def refresh(month_day):
+        try:
+            outcome = "updated" if otd_store_refresh(month_day)[1] else "unchanged"
+        except Exception as e:
+            outcome = "failed"
+            print(f"  ❌ {month_day}: {e}")
+        with lock:
+            counts[outcome] += 1
+
+    print(f"🗓️  Refreshing 'On This Day' store for {len(dates)} dates → {OTD_STORE_DIR}")
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max(1, OTD_STORE_CONCURRENCY)) as pool:
+        list(pool.map(refresh, dates))
+    print(f"✅ {counts['updated']} updated, {counts['unchanged']} unchanged (304), "
+          f"{counts['failed']} failed in {time.monotonic() - start:.1f}s")
 
+# ─────────────────────────────────────────────────────────────
+# HISTORY CATALOGUE  (SQLite, indexed by id / year / era)
+# HISTORICAL_EVENTS above is synced into it on every run; grow it
+# with `--import-history events.jsonl`. The daily 4+4 are drawn by random
+# rowid probes (no full scan), skipping events shown in the last
+# HISTORY_NO_REPEAT_DAYS and event+style pairs from the last
+# HISTORY_PAIR_NO_REPEAT_DAYS; every day's picks are recorded.
+# ─────────────────────────────────────────────────────────────
+HISTORY_DB                  = os.environ.get("HISTORY_DB", os.path.join(STATE_DIR, "history.sqlite"))
+HISTORY_NO_REPEAT_DAYS      = int(os.environ.get("HISTORY_NO_REPEAT_DAYS", "60"))
+HISTORY_PAIR_NO_REPEAT_DAYS = int(os.environ.get("HISTORY_PAIR_NO_REPEAT_DAYS", "365"))
+HISTORY_ERAS = [(500, "late-antiquity"), (1500, "medieval"), (1800, "early-modern"),
+                (1945, "modern"), (10**6, "contemporary")]
+
+def history_era(year):
+    return next(era for end, era in HISTORY_ERAS if year < end)
+
+def open_history_db():
+    """Open (and on first use create + seed) the catalogue."""
+    os.makedirs(os.path.dirname(HISTORY_DB) or ".", exist_ok=True)
+    db = sqlite3.connect(HISTORY_DB)
+    db.row_factory = sqlite3.Row
+    db.executescript("""
+        CREATE TABLE IF NOT EXISTS events (
+            id TEXT PRIMARY KEY, year INTEGER NOT NULL, era TEXT NOT NULL,
+            headline TEXT NOT NULL, prompt_base TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS events_year ON events(year);
+        CREATE INDEX IF NOT EXISTS events_era ON events(era, year);
+        CREATE TABLE IF NOT EXISTS usage (
+            day TEXT NOT NULL, event_id TEXT NOT NULL, style_id TEXT, role TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS usage_day ON usage(day);
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+    """)
+    # rev = catalogue revision that last added/changed the row (drives incremental indexing)
+    if "rev" not in {col["name"] for col in db.execute("PRAGMA table_info(events)")}:
+        with db:
+            db.execute("ALTER TABLE events ADD COLUMN rev INTEGER NOT NULL DEFAULT 0")
+            db.execute("CREATE INDEX IF NOT EXISTS events_rev ON events(rev)")
+    import_history_events(db, HISTORICAL_EVENTS)   # keeps edits to the built-in list
+    return db
+
+def catalogue_revision(db):
+    row = db.execute("SELECT value FROM meta WHERE key = 'revision'").fetchone()
+    return row[0] if row else 0
+
+def import_history_events(db, events):
+    """Insert or update events ({id, year, headline, prompt_base[, era]}).
+    Returns how many rows were new or changed."""
+    before = db.total_changes
+    revision = catalogue_revision(db) + 1
+    with db:
+        db.executemany("""
+            INSERT INTO events (id, year, era, headline, prompt_base, rev) VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(id) DO UPDATE SET year = excluded.year, era = excluded.era,
+                headline = excluded.headline, prompt_base = excluded.prompt_base, rev = excluded.rev
+            WHERE (year, era, headline, prompt_base)
+                  IS NOT (excluded.year, excluded.era, excluded.headline, excluded.prompt_base)""",
+                       ((ev["id"], ev["year"], ev.get("era") or history_era(ev["year"]),
+                         ev["headline"], ev["prompt_base"], revision) for ev in events))
+        changed = db.total_changes - before
+        if changed:
+            db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('revision', ?)", (revision,))
+    return changed
+
+def import_history_file(path):
+    """--import-history: load a JSONL file of events into the catalogue."""
+    db = open_history_db()
+    with open(path) as f:
+        n = import_history_events(db, (json.loads(line) for line in f if line.strip()))
+    total = db.execute("SELECT count(*) FROM events").fetchone()[0]
+    print(f"✅ Imported {n} events from {path} ({total} in {HISTORY_DB})")
+
+def history_event(db, event_id):
+    row = db.execute("SELECT id, year, era, headline, prompt_base FROM events WHERE id = ?", (event_id,)).fetchone()
+    return dict(row) if row else None
+
+def recent_history_usage(db, day, days):
+    """(event ids, (event id, style id) pairs) used in the `days` before `day`."""
+    since = (datetime.date.fromisoformat(day) - datetime.timedelta(days=days)).isoformat()
+    rows = db.execute("SELECT event_id, style_id FROM usage WHERE day >= ? AND day < ?", (since, day)).fetchall()
+    return {r["event_id"] for r in rows}, {(r["event_id"], r["style_id"]) for r in rows if r["style_id"]}
+
+def recently_shown(db, day, count=8):
+    """Event ids inside the no-repeat window, which shrinks if the catalogue is too
+    small to honour it. Returns (ids, how many events can be drawn)."""
+    # Only small catalogues need their exact size, so never count past what the window needs
+    size = db.execute("SELECT count(*) FROM (SELECT 1 FROM events LIMIT ?)",
+                      (count * (HISTORY_NO_REPEAT_DAYS + 1),)).fetchone()[0]
+    count = min(count, size)
+    days = min(HISTORY_NO_REPEAT_DAYS, max(0, (size - count) // max(1, count)))
+    return recent_history_usage(db, day, days)[0], count
+
+def sample_history_events(db, rng, day, count=8):
+    """Draw `count` distinct events not shown recently, deterministic for a given rng.
+    Each draw is one indexed rowid probe."""
+    max_rowid = db.execute("SELECT max(rowid) FROM events").fetchone()[0] or 0
+    recent, count = recently_shown(db, day, count)
+    picked, seen = [], set()
+    for _ in range(count * 50):
+        if len(picked) == count:
+            break
+        row = (db.execute("SELECT id, year, era, headline, prompt_base FROM events WHERE rowid >= ? "
+                          "ORDER BY rowid LIMIT 1", (rng.randint(1, max_rowid),)).fetchone())
+        if row is None or row["id"] in seen:
+            continue
+        seen.add(row["id"])
+        if row["id"] not in recent:
+            picked.append(dict(row))
+    if len(picked) < count:   # unlucky probes: fill up in rowid order
+        for row in db.execute("SELECT id, year, era, headline, prompt_base FROM events ORDER BY rowid"):
+            if len(picked) == count:
+                break
+            if row["id"] not in recent and row["id"] not in {ev["id"] for ev in picked}:
+                picked.append(dict(row))
+    return picked
+
+def pick_history_style(rng, event_id, recent_pairs):
+    """A random art style this event wasn't shown in recently (any style if all were)."""
+    fresh = [st for st in ART_STYLES if (event_id, st["id"]) not in recent_pairs]
+    return rng.choice(fresh or ART_STYLES)
+
+def record_history_usage(db, day, main, styles, distractors):
+    """Remember today's picks (replacing an earlier run of the same day)."""
+    with db:
+        db.execute("DELETE FROM usage WHERE day = ?", (day,))
+        db.executemany("INSERT INTO usage (day, event_id, style_id, role) VALUES (?, ?, ?, ?)",
+                       [(day, ev["id"], st["id"], "main") for ev, st in zip(main, styles)]
+                       + [(day, ev["id"], None, "distractor") for ev in distractors])
+
+# ─────────────────────────────────────────────────────────────
+# SIMILARITY INDEX  (plausible distractors, optional NumPy)
+# Each catalogue event gets a hashed bag-of-words vector of its
+# headline + prompt; scores blend text cosine with year closeness.
+# A top-k neighbour table over a year-ordered band is precomputed
+# and cached as memory-mapped .npy files, so picking decoys for the
+# day's 4 events is a few array lookups. Only rows near new/changed
+# events (catalogue `rev` > indexed revision) are recomputed.
+# Needs `pip install numpy`; without it distractors stay random.
+# ─────────────────────────────────────────────────────────────
 try:
-    print("\n🗓️  FETCHING 'ON THIS DAY' EVENTS FROM WIKIPEDIA...")
-    all_events = fetch_onthisday_events()
-    print(f"   Found {len(all_events)} total events for {today}")
-    
-    main_events, distractor_events = select_otd_events(all_events)
+    import numpy as np
+except ImportError:
+    np = None
+
+SIMILARITY_DIR        = os.environ.get("SIMILARITY_INDEX_DIR", os.path.join(STATE_DIR, "history-index"))
+SIMILARITY_DIMS       = 256     # hashed word features
+SIMILARITY_NEIGHBOURS = 16      # neighbours kept per event
+SIMILARITY_BAND       = 512     # candidates on each side in year order
+SIMILARITY_BLOCK      = 256     # rows scored per matrix product
+SIMILARITY_YEAR_SCALE = 100.0   # years over which year closeness decays
+SIMILARITY_DUPLICATE  = 0.8     # text cosine above this = the same event, never a decoy
+SIMILARITY_ARRAYS     = ("ids", "sorted_ids", "id_order", "years", "vectors", "neighbours")
+SIMILARITY_STOPWORDS  = frozenset("the and with for from into over under his her their its "
+                                  "ad bc style highly detailed dramatic scene".split())
+
+def text_features(texts):
+    """L2-normalised signed hashed bag-of-words, float32 (len(texts) × SIMILARITY_DIMS)."""
+    out = np.zeros((len(texts), SIMILARITY_DIMS), dtype=np.float32)
+    for row, text in enumerate(texts):
+        for word in re.findall(r"[a-z]{3,}", text.lower()):
+            if word not in SIMILARITY_STOPWORDS:
+                h = zlib.crc32(word.encode())
+                out[row, h % SIMILARITY_DIMS] += 1.0 if h & 0x80000000 else -1.0
+    return out / np.maximum(np.linalg.norm(out, axis=1, keepdims=True), 1e-9)
+
+def similarity_scores(q_vectors, q_years, c_vectors, c_years):
+    """Queries × candidates: text cosine blended with year closeness. Near-duplicates
+    score -inf, so decoys are close but never the same event."""
+    text = q_vectors @ c_vectors.T
+    years = np.exp(-np.abs(q_years[:, None] - c_years[None, :]) / SIMILARITY_YEAR_SCALE)
+    score = 0.4 * text + 0.6 * years
+    score[text > SIMILARITY_DUPLICATE] = -np.inf
+    return score
+
+def compute_neighbours(years, vectors, neighbours, changed_rows=None):
+    """Fill neighbours[row] with its top-k rows among ±SIMILARITY_BAND events in year order.
+    With changed_rows only the blocks whose band contains one of them are recomputed."""
+    n = len(years)
+    order = np.argsort(years, kind="stable")
+    affected = None
+    if changed_rows is not None:
+        position = np.empty(n, dtype=np.int64)
+        position[order] = np.arange(n)
+        affected = np.sort(position[changed_rows])
+    for start in range(0, n, SIMILARITY_BLOCK):
+        lo, hi = max(0, start - SIMILARITY_BAND), min(n, start + SIMILARITY_BLOCK + SIMILARITY_BAND)
+        if affected is not None and np.searchsorted(affected, lo) == np.searchsorted(affected, hi):
+            continue
+        rows, cands = order[start:start + SIMILARITY_BLOCK], order[lo:hi]
+        score = similarity_scores(vectors[rows], years[rows], vectors[cands], years[cands])
+        score[rows[:, None] == cands[None, :]] = -np.inf
+        k = min(SIMILARITY_NEIGHBOURS, len(cands) - 1)
+        neighbours[rows] = -1
+        if k <= 0:
+            continue
+        top = np.argpartition(-score, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(score, top, axis=1)
+        by_score = np.argsort(-top_scores, axis=1, kind="stable")
+        top, top_scores = np.take_along_axis(top, by_score, 1), np.take_along_axis(top_scores, by_score, 1)
+        neighbours[rows, :k] = np.where(np.isfinite(top_scores), cands[top], -1)
+
+def load_similarity_index():
+    """Memory-mapped index arrays + meta, or None if there is no usable index."""
+    try:
+        with open(os.path.join(SIMILARITY_DIR, "meta.json")) as f:
+            meta = json.load(f)
+        index = {name: np.load(os.path.join(SIMILARITY_DIR, f"{name}.npy"), mmap_mode="r")
+                 for name in SIMILARITY_ARRAYS}
+    except (OSError, ValueError):
+        return None
+    settings = [SIMILARITY_DIMS, SIMILARITY_NEIGHBOURS, SIMILARITY_BAND, SIMILARITY_YEAR_SCALE]
+    return dict(index, meta=meta) if meta.get("settings") == settings else None
+
+def save_similarity_index(index, revision):
+    """Write all arrays to a temp dir, then swap it in."""
+    tmp_dir, old_dir = f"{SIMILARITY_DIR}.tmp", f"{SIMILARITY_DIR}.old"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    for name in SIMILARITY_ARRAYS:
+        array = index[name].astype(np.float16) if name == "vectors" else index[name]   # halves the biggest file
+        np.save(os.path.join(tmp_dir, f"{name}.npy"), array)
+    settings = [SIMILARITY_DIMS, SIMILARITY_NEIGHBOURS, SIMILARITY_BAND, SIMILARITY_YEAR_SCALE]
+    write_json_atomic(os.path.join(tmp_dir, "meta.json"), {"revision": revision, "settings": settings})
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if os.path.exists(SIMILARITY_DIR):
+        os.replace(SIMILARITY_DIR, old_dir)
+    os.replace(tmp_dir, SIMILARITY_DIR)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+def update_similarity_index(db):
+    """The index for the catalogue's current revision, updating it first if needed.
+    None without NumPy."""
+    if np is None:
+        return None
+    revision = catalogue_revision(db)
+    index = load_similarity_index()
+    if index and index["meta"]["revision"] == revision:
+        return index
+
+    start = time.monotonic()
+    size = db.execute("SELECT count(*) FROM events").fetchone()[0]
+    since = index["meta"]["revision"] if index else -1
+    rows = db.execute("SELECT id, year, headline, prompt_base FROM events WHERE rev > ?", (since,)).fetchall()
+    ids = [str(i) for i in index["ids"]] if index else []
+    row_of = {event_id: row for row, event_id in enumerate(ids)}
+    if len(ids) + sum(1 for r in rows if r["id"] not in row_of) != size:
+        # Events were deleted: row numbers shift, so start over
+        index, ids, row_of = None, [], {}
+        rows = db.execute("SELECT id, year, headline, prompt_base FROM events").fetchall()
+    for r in rows:
+        if r["id"] not in row_of:
+            row_of[r["id"]] = len(ids)
+            ids.append(r["id"])
+
+    years = np.zeros(len(ids), dtype=np.float32)
+    vectors = np.zeros((len(ids), SIMILARITY_DIMS), dtype=np.float32)
+    neighbours = np.full((len(ids), SIMILARITY_NEIGHBOURS), -1, dtype=np.int32)
+    if index:
+        kept = len(index["ids"])
+        years[:kept], vectors[:kept], neighbours[:kept] = index["years"], index["vectors"], index["neighbours"]
+    changed = np.array([row_of[r["id"]] for r in rows], dtype=np.int64)
+    if len(rows):
+        years[changed] = [r["year"] for r in rows]
+        vectors[changed] = text_features([f"{r['headline']} {r['prompt_base']}" for r in rows])
+    compute_neighbours(years, vectors, neighbours, changed if index else None)
+
+    ids = np.array(ids, dtype=str)
+    id_order = np.argsort(ids, kind="stable")
+    index = {"ids": ids, "sorted_ids": ids[id_order], "id_order": id_order,
+             "years": years, "vectors": vectors, "neighbours": neighbours}
+    save_similarity_index(index, revision)
+    print(f"🧭 Similarity index: {len(rows)} of {len(ids)} events (re)indexed in {time.monotonic() - start:.2f}s")
+    return load_similarity_index()
+
+def plausible_distractors(index, chosen_ids, exclude=(), count=4):
+    """Up to `count` catalogue ids close to the chosen events, taking each chosen
+    event's next-best neighbour in turn and skipping `exclude`."""
+    sorted_ids = index["sorted_ids"]
+    lists = []
+    for event_id in chosen_ids:
+        pos = int(np.searchsorted(sorted_ids, event_id))
+        if pos < len(sorted_ids) and sorted_ids[pos] == event_id:
+            lists.append(index["neighbours"][index["id_order"][pos]])
+    skip, picked = set(exclude) | set(chosen_ids), []
+    for rank in range(SIMILARITY_NEIGHBOURS):
+        for neighbours in lists:
+            row = int(neighbours[rank])
+            if row >= 0 and str(index["ids"][row]) not in skip and len(picked) < count:
+                picked.append(str(index["ids"][row]))
+                skip.add(picked[-1])
+    return picked
+
+def similar_otd_distractors(events, main, count=4):
+    """Decoys for the On This Day main events: the closest remaining feed candidates
+    (same scoring, computed on the fly). None without NumPy or too few candidates."""
+    chosen = {(evt["year"], evt["text"]) for evt in main}
+    cands = [evt for evt in events if OTD_MIN_YEAR <= evt["year"] <= OTD_MAX_YEAR and evt["pages"]
+             and (evt["year"], evt["text"]) not in chosen]
+    if np is None or not main or len(cands) < count:
+        return None
+    score = similarity_scores(text_features([evt["text"] for evt in main]),
+                              np.array([evt["year"] for evt in main], dtype=np.float32),
+                              text_features([evt["text"] for evt in cands]),
+                              np.array([evt["year"] for evt in cands], dtype=np.float32))
+    ranked = np.argsort(-score, axis=1, kind="stable")
+    picked = []
+    for rank in range(len(cands)):
+        for q in range(len(main)):
+            i = int(ranked[q, rank])
+            if np.isfinite(score[q, i]) and i not in picked and len(picked) < count:
+                picked.append(i)
+        if len(picked) == count:
+            break
+    return [dict(cands[i], score=otd_score(cands[i]["text"])) for i in picked]
+
+# ─────────────────────────────────────────────────────────────
+# DAILY SELECTION  (history + On This Day, seeded by the date)
+# Shared by the daily run and --prerender-days, so a staged day
+# shows exactly what the daily run would have picked itself.
+# ─────────────────────────────────────────────────────────────
+def day_seed(day):
+    """Seed by date so same day always gives same events + styles."""
+    return int(hashlib.md5(day.encode()).hexdigest(), 16) % (2**32)
+
+def style_prompt(base, style):
+    return f"{base}, {style['suffix']}, highly detailed, award-winning composition"
+
+def otd_headline(text):
+    headline = text.split('.')[0]  # First sentence
+    return headline[:97] + "..." if len(headline) > 100 else headline
+
+def plan_history(db, rng, day):
+    """Pick 8 events not shown recently (first 4 get images, next 4 are decoys) and
+    the 4 art styles. Returns [(event, style, prompt)] and the decoy events."""
+    events = sample_history_events(db, rng, day, 8)
+    # Decoys close in era/theme to the 4 main events, instead of 4 random ones
+    similarity = update_similarity_index(db)
+    if similarity is not None:
+        close = plausible_distractors(similarity, [ev["id"] for ev in events[:4]], recently_shown(db, day)[0])
+        events = (events[:4] + [history_event(db, i) for i in close]
+                  + [ev for ev in events[4:] if ev["id"] not in close])[:8]
+    _, recent_pairs = recent_history_usage(db, day, HISTORY_PAIR_NO_REPEAT_DAYS)
+    styles = [pick_history_style(rng, ev["id"], recent_pairs) for ev in events[:4]]
+
+    # A journaled selection wins, so a resumed or staged day renders exactly what was planned
+    styles_by_id = {st["id"]: st for st in ART_STYLES}
+    journaled = journal_plan("history", {"events": [ev["id"] for ev in events],
+                                         "styles": [st["id"] for st in styles]})
+    replayed = [history_event(db, i) for i in journaled["events"]]
+    if all(replayed) and all(i in styles_by_id for i in journaled["styles"]):
+        events = replayed
+        styles = [styles_by_id[i] for i in journaled["styles"]]
+    record_history_usage(db, day, events[:4], styles, events[4:8])
+    return [(ev, st, style_prompt(ev["prompt_base"], st)) for ev, st in zip(events[:4], styles)], events[4:8]
+
+def queue_history(plan, force=False):
+    return [
+        queue_image(
+            "history", full_prompt, f"hi{i+1}.png",
+            f"🏛️  [HISTORY via Replicate/Flux] {event['headline'][:50]}... [{style['name']}]",
+            {"id": f"hi{i+1}", "headline": event["headline"],
+             "year": event["year"], "source": "Historical Record",
+             "style": style["name"], "image": None},
+            force, journal={"event_id": event["id"], "style_id": style["id"]})
+        for i, (event, style, full_prompt) in enumerate(plan)
+    ]
+
+def plan_otd(rng, ranked):
+    """The 4 main On This Day events with style, headline + prompt, and the distractor
+    events. A journaled pick is replayed; otherwise ranked() supplies it (None if unavailable)."""
+    if "otd" in JOURNAL:
+        # Resumed or staged day: reuse the journaled selection instead of refetching
+        print("\n↩️  Replaying 'On This Day' selection from journal")
+        styles_by_id = {st["id"]: st for st in ART_STYLES}
+        main_events, distractor_events = JOURNAL["otd"]["main"], JOURNAL["otd"]["distractors"]
+        styles = [styles_by_id.get(evt["style_id"]) or rng.choice(ART_STYLES) for evt in main_events]
+    else:
+        picked = ranked()
+        if picked is None:
+            raise Exception("no 'On This Day' events fetched yet (otd-fetch not selected)")
+        print(f"   Found {picked['events']} total events for {JOURNAL['date']}")
+        main_events, distractor_events = picked["main"], picked["distractors"]
+        styles = [rng.choice(ART_STYLES) for _ in main_events]
+        journal_plan("otd", {
+            "main": [{"year": evt["year"], "text": evt["text"], "style_id": style["id"]}
+                     for evt, style in zip(main_events, styles)],
+            "distractors": [{"year": evt["year"], "text": evt["text"]} for evt in distractor_events],
+        })
     print(f"   Selected {len(main_events)} main events + {len(distractor_events)} distractors\n")
-    
-    # Generate images for the 4 main events
-    for i, evt in enumerate(main_events):
-        style = rng.choice(ART_STYLES)
-        filename = f"otd{i+1}.png"
-        out_path = os.path.join(OUT_DIR, filename)
-        
-        # Create headline from event text
-        headline_text = evt['text'].split('.')[0]  # First sentence
-        if len(headline_text) > 100:
-            headline_text = headline_text[:97] + "..."
-        
-        if os.path.exists(out_path):
-            print(f"  ⏭  {filename} already exists, skipping")
-            otd_items.append({
+    plan = [(evt, style, otd_headline(evt["text"]),
+             style_prompt(create_otd_prompt(evt["text"], evt["year"]), style))
+            for evt, style in zip(main_events, styles)]
+    return plan, distractor_events
+
+def queue_otd(plan, force=False):
+    return [
+        queue_image(
+            "otd", full_prompt, f"otd{i+1}.png",
+            f"🗓️  [ON THIS DAY via Replicate/Flux] Year {evt['year']}: {headline_text[:60]}... [{style['name']}]",
+            {
                 "id": f"otd{i+1}",
                 "headline": headline_text,
                 "year": evt['year'],
                 "source": "Wikipedia",
                 "style": style["name"],
-                "image": f"images/{filename}"
-            })
-            continue
-        
-        # Create prompt
-        base_prompt = create_otd_prompt(evt['text'], evt['year'])
-        full_prompt = f"{base_prompt}, {style['suffix']}, highly detailed, award-winning composition"
-        
-        print(f"🗓️  [ON THIS DAY via Replicate/Flux] Year {evt['year']}: {headline_text[:60]}... [{style['name']}]")
-        
+                "image": None
+            },
+            force, journal={"year": evt["year"], "style_id": style["id"]})
+        for i, (evt, style, headline_text, full_prompt) in enumerate(plan)
+    ]
+
+# ─────────────────────────────────────────────────────────────
+# LOOK-AHEAD PRE-RENDERING  (--prerender-days N)
+# The history + On This Day images of the next N dates are planned
+# and rendered off-peak into a staging folder per date (images +
+# that date's journal), outside the webroot so nothing leaks early.
+# The daily run promotes them into images/ and replays the journal,
+# leaving only the news images and collages on the critical path.
+# ─────────────────────────────────────────────────────────────
+PRERENDER_DIR = os.environ.get("QUIZ_PRERENDER_DIR", os.path.join(STATE_DIR, "prerender"))
+
+def staged_dir(day):
+    return os.path.join(PRERENDER_DIR, day)
+
+def prerender_days(count):
+    """Stage the next `count` dates that have no daily run yet (today included)."""
+    global OUT_DIR, JOURNAL_DIR
+    today = datetime.date.today()
+    first = 1 if os.path.exists(journal_path(today.isoformat())) else 0
+    days = [(today + datetime.timedelta(days=n)).isoformat() for n in range(first, first + count)]
+    print(f"📅 Pre-rendering {len(days)} days ({days[0]} → {days[-1]}) into {PRERENDER_DIR}")
+    start = time.monotonic()
+    staged = 0
+    live_dirs = OUT_DIR, JOURNAL_DIR
+    db = open_history_db()
+    try:
+        for day in days:
+            OUT_DIR = JOURNAL_DIR = staged_dir(day)
+            os.makedirs(OUT_DIR, exist_ok=True)
+            print(f"\n▶️  [prerender {day}]")
+            BUILD_STATE["images"] = {}
+            load_journal(day)
+            rng = random.Random(day_seed(day))
+            IMAGE_JOBS.clear()
+            METRICS["stage"] = "prerender"
+            items = queue_history(plan_history(db, rng, day)[0])
+            try:
+                items += queue_otd(plan_otd(rng, lambda: otd_ranked(day[5:], max_age_days=OTD_STORE_MAX_DAYS))[0])
+            except Exception as e:
+                print(f"  ⚠️  'On This Day' not staged, the daily run will do it: {e}")
+            run_image_jobs(IMAGE_JOBS)
+            staged += sum(1 for it in items if it["image"])
+    finally:
+        db.close()
+        OUT_DIR, JOURNAL_DIR = live_dirs
+    print(f"\n✅ {staged} images staged for {len(days)} days in {time.monotonic() - start:.1f}s")
+
+def promote_staged(day):
+    """Move a staged day's images into OUT_DIR and adopt its selection; a selection already
+    journaled today wins. Staging folders of this and past days are removed afterwards."""
+    promoted = 0
+    path = os.path.join(staged_dir(day), f"journal-{day}.json")
+    if os.path.exists(path):
         try:
-            image_path = generate_image_replicate(full_prompt, filename)
-            otd_items.append({
-                "id": f"otd{i+1}",
-                "headline": headline_text,
-                "year": evt['year'],
-                "source": "Wikipedia",
-                "style": style["name"],
-                "image": image_path
-            })
-        except Exception as e:
-            print(f"  ❌ Error: {e}")
+            with open(path) as f:
+                staged = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"⚠️  Ignoring unreadable staged journal: {e}")
+            staged = {"jobs": {}}
+        for name in ("history", "otd"):
+            if name in staged:
+                journal_plan(name, staged[name])
+        for filename, job in staged["jobs"].items():
+            src = os.path.join(staged_dir(day), filename)
+            if (job.get("status") != "done" or not os.path.exists(src)
+                    or JOURNAL["jobs"].get(filename, {}).get("status") == "done"):
+                continue
+            dest = os.path.join(OUT_DIR, filename)
+            try:
+                os.replace(src, dest)
+            except OSError:   # staging folder on another filesystem
+                with open(src, "rb") as f:
+                    write_atomic(dest, iter_chunks(f))
+            BUILD_STATE["images"][filename] = job["prompt_hash"]
+            journal_job(filename, **job)
+            promoted += 1
+        print(f"📦 Promoted {promoted} pre-rendered images for {day}")
+    if os.path.isdir(PRERENDER_DIR):
+        for name in os.listdir(PRERENDER_DIR):
+            if name <= day:
+                shutil.rmtree(os.path.join(PRERENDER_DIR, name), ignore_errors=True)
+    return promoted
+
+# ─────────────────────────────────────────────────────────────
+# SETUP
+# ─────────────────────────────────────────────────────────────
+parser = argparse.ArgumentParser(description="Generate today's News Quiz images + quiz-data.json")
+parser.add_argument("--backfill-variants", action="store_true",
+                    help="only add WebP/AVIF variants to quiz-data.json and the archived quiz JSONs, then exit")
+parser.add_argument("--only", action="append", default=[], choices=STAGE_NAMES, metavar="STAGE",
+                    help=f"run only this stage (repeatable); others reuse their last output. Stages: {', '.join(STAGE_NAMES)}")
+parser.add_argument("--rebuild", action="append", default=[], choices=STAGE_NAMES, metavar="STAGE",
+                    help="run this stage (repeatable) and re-render its images even if nothing changed")
+parser.add_argument("--backfill-placeholders", action="store_true",
+                    help="add inline placeholders + dominant colours to quiz-data.json and every archived day, then exit")
+parser.add_argument("--backfill-packs", action="store_true",
+                    help="write missing day packs (packs/quiz-YYYY-MM-DD.pack) for archived days, then exit")
+parser.add_argument("--verify-packs", action="store_true",
+                    help="check every day pack's checksums and contents, then exit (status 1 if one is bad)")
+parser.add_argument("--rebuild-archive-summary", action="store_true",
+                    help="rewrite the monthly archive summary pages (archive/YYYY-MM.json) from the archived days, then exit")
+parser.add_argument("--import-history", metavar="JSONL",
+                    help="add/update historical events (one JSON object per line) in the catalogue, then exit")
+parser.add_argument("--refresh-otd-store", action="store_true",
+                    help="fill/revalidate the local 'On This Day' store for all 366 dates, then exit")
+parser.add_argument("--prerender-days", type=int, metavar="N",
+                    help="plan + render the history and 'On This Day' images of the next N dates into the staging area, then exit")
+parser.add_argument("--profile", action="store_true",
+                    help="write a trace-event timeline of the run (chrome://tracing, ui.perfetto.dev) to the state dir")
+parser.add_argument("--profile-cpu", action="store_true",
+                    help="with --profile, also write a cProfile dump (.prof) next to the trace")
+args = parser.parse_args()
+
+if args.backfill_variants:
+    backfill_variants()
+    sys.exit(0)
+if args.backfill_placeholders:
+    backfill_placeholders()
+    sys.exit(0)
+if args.backfill_packs:
+    backfill_packs()
+    sys.exit(0)
+if args.verify_packs:
+    sys.exit(1 if verify_packs() else 0)
+if args.rebuild_archive_summary:
+    rebuild_archive_summary()
+    sys.exit(0)
+if args.refresh_otd_store:
+    refresh_otd_store()
+    sys.exit(0)
+if args.import_history:
+    import_history_file(args.import_history)
+    sys.exit(0)
+if args.prerender_days:
+    prerender_days(args.prerender_days)
+    sys.exit(0)
+
+os.makedirs(OUT_DIR, exist_ok=True)
+today = datetime.date.today().isoformat()
+run_start = time.monotonic()
+if args.profile or args.profile_cpu:
+    start_profiling(cpu=args.profile_cpu)
+load_build_state()
+load_journal(today)
+
+# ─────────────────────────────────────────────────────────────
+# STAGE: ARCHIVE YESTERDAY'S QUIZ
+# ─────────────────────────────────────────────────────────────
+def build_archive(force):
+    if not os.path.exists(JSON_PATH):
+        return None
+    try:
+        with open(JSON_PATH) as f:
+            old = json.load(f)
+        old_date = old.get("date", "")
+        if old_date and old_date != today:
+            already_indexed = os.path.exists(os.path.join(MANIFEST_DIR, f"{old_date}.json"))
+            # Store + relink all images (categories, collages, On This Day)
+            manifest = archive_day(old_date, old)
+            # Write archived quiz-data-YYYY-MM-DD.json
+            archive_json = os.path.join(WEBROOT, f"quiz-data-{old_date}.json")
+            write_public_json(archive_json, old)
+            # ...and the whole day as one pack file for the archive replay
+            write_day_pack(old_date, old)
+            # ...and its entry on this month's archive summary page
+            update_archive_summary(old_date, old)
+            # Append to archive-index.json (the manifest tells us if it's already listed)
+            if not already_indexed:
+                append_json_list(os.path.join(WEBROOT, "archive-index.json"), old_date)
+            print(f"✅ Archived {old_date} → images/blobs/ ({len(manifest['files'])} files) + quiz-data-{old_date}.json")
+            return old_date
+    except Exception as e:
+        print(f"⚠️  Archive skipped: {e}")
+    return None
+
+def current_quiz_date():
+    try:
+        with open(JSON_PATH) as f:
+            return json.load(f).get("date", "")
+    except (OSError, ValueError):
+        return ""
+
+run_stage("archive", {"today": today, "current": current_quiz_date()}, build_archive)
+# Only after archiving: promoted images replace yesterday's in images/
+promote_staged(today)
+
+# ─────────────────────────────────────────────────────────────
+# STAGE: GERMANY + WORLD CATEGORY IMAGES
+# ─────────────────────────────────────────────────────────────
+def build_news(force):
+    return {
+        cat_key: [
+            queue_image("news", item["prompt"], f"{item['id']}.png",
+                        f"🖼  [{cat_key.upper()} via Replicate/Flux] {item['headline'][:55]}...",
+                        {"id": item["id"], "headline": item["headline"], "source": item["source"], "image": None},
+                        force, journal={"item_id": item["id"]})
+            for item in items
+        ]
+        for cat_key, items in CATEGORIES.items()
+    }
+
+quiz_categories = dict(run_stage("news", CATEGORIES, build_news) or {})
+
+# ─────────────────────────────────────────────────────────────
+# STAGE: HISTORY CATEGORY IMAGES
+# Seed by date so same day always gives same events + styles
+# ─────────────────────────────────────────────────────────────
+date_seed = day_seed(today)
+rng = random.Random(date_seed)
+
+history_db = open_history_db()
+history_plan, history_distractors = plan_history(history_db, rng, today)
+history_db.close()
+
+history_items = run_stage("history", {
+    "date_seed": date_seed,
+    "events": [[ev["id"], ev["year"], ev["headline"], style["id"], prompt] for ev, style, prompt in history_plan],
+}, lambda force: queue_history(history_plan, force)) or []
+
+history_distractor_items = [
+    {"id": f"hd{i+1}", "headline": ev["headline"],
+     "year": ev["year"], "source": "Historical Record"}
+    for i, ev in enumerate(history_distractors)
+]
+quiz_categories["history"] = history_items
+
+# ─────────────────────────────────────────────────────────────
+# STAGES: "ON THIS DAY" FETCH + IMAGES (Wikipedia API)
+# ─────────────────────────────────────────────────────────────
+def build_otd_fetch(force):
+    print("\n🗓️  LOOKING UP 'ON THIS DAY' EVENTS...")
+    # Only the precomputed pick goes into the build state
+    return otd_ranked(today[5:], revalidate=force)
+
+# Plan On This Day quiz data
+otd_items = []
+otd_distractor_items = []
+
+try:
+    otd_plan, distractor_events = plan_otd(
+        rng, lambda: run_stage("otd-fetch", {"month_day": today[5:], "output": "ranked"}, build_otd_fetch))
+    otd_items = run_stage("otd", [[evt["year"], style["id"], headline_text, full_prompt]
+                                  for evt, style, headline_text, full_prompt in otd_plan],
+                          lambda force: queue_otd(otd_plan, force)) or []
     
     # Create distractor items (no images)
     for i, evt in enumerate(distractor_events):
-        headline_text = evt['text'].split('.')[0]
-        if len(headline_text) > 100:
-            headline_text = headline_text[:97] + "..."
-        
         otd_distractor_items.append({
             "id": f"otdd{i+1}",
-            "headline": headline_text,
+            "headline": otd_headline(evt['text']),
             "year": evt['year'],
             "source": "Wikipedia"
         })
-    
-    print(f"\n✅ Generated {len(otd_items)} On This Day images")
-    print(f"   Years: {[it['year'] for it in otd_items]}")
-    print(f"   Styles: {[it['style'] for it in otd_items]}")
 
 except Exception as e:
     print(f"\n⚠️  Failed to generate On This Day content: {e}")
     print("   Continuing without otd data...")
 
 # ─────────────────────────────────────────────────────────────
-# GENERATE COLLAGE IMAGES
+# STAGE: COLLAGE IMAGES
 # ─────────────────────────────────────────────────────────────
+def build_collages(force):
+    return {
+        cat_key: {
+            style_key: queue_image(
+                "collages", info["prompt"], f"collage_{cat_key}_{style_key}.png",
+                f"🎨  [COLLAGE {cat_key.upper()} / {style_key.upper()}] generating...",
+                {"image": None, "style": info["style"]},
+                force, journal={"category": cat_key, "style_id": style_key})
+            for style_key, info in styles.items()
+        }
+        for cat_key, styles in COLLAGE_PROMPTS.items()
+    }
+
+# With COLLAGE_ENGINE=local the collages are composited after the render below
 quiz_collages = {}
-for cat_key, styles in COLLAGE_PROMPTS.items():
-    quiz_collages[cat_key] = {}
-    for style_key, info in styles.items():
-        filename = f"collage_{cat_key}_{style_key}.png"
-        out_path = os.path.join(OUT_DIR, filename)
-        if os.path.exists(out_path):
-            print(f"  ⏭  {filename} already exists, skipping")
-            quiz_collages[cat_key][style_key] = {"image": f"images/{filename}", "style": info["style"]}
-            continue
-        print(f"\n🎨  [COLLAGE {cat_key.upper()} / {style_key.upper()}] generating...")
-        try:
-            image_path = generate_image(info["prompt"], filename)
-            quiz_collages[cat_key][style_key] = {"image": image_path, "style": info["style"]}
-        except Exception as e:
-            print(f"  ❌ Error: {e}")
+if COLLAGE_ENGINE != "local":
+    quiz_collages = dict(run_stage("collages", COLLAGE_PROMPTS, build_collages) or {})
+
+# ─────────────────────────────────────────────────────────────
+# RENDER ALL PLANNED IMAGES (concurrently) + DROP FAILED ITEMS
+# ─────────────────────────────────────────────────────────────
+render_start = time.monotonic()
+with span("render", "stage"):
+    run_image_jobs(IMAGE_JOBS)
+STAGE_TIMES["render"] = round(time.monotonic() - render_start, 3)
+
+for cat_key in quiz_categories:
+    quiz_categories[cat_key] = [it for it in quiz_categories[cat_key] if it["image"]]
+history_items = quiz_categories["history"]
+otd_items = [it for it in otd_items if it["image"]]
+for cat_key, styles in quiz_collages.items():
+    quiz_collages[cat_key] = {k: v for k, v in styles.items() if v["image"]}
+
+if COLLAGE_ENGINE == "local":
+    collage_inputs = {"engine": "local", "size": COLLAGE_SIZE, "looks": COLLAGE_LOOKS, "seed": day_seed(today),
+                      "refine": [COLLAGE_REFINE_MODEL, COLLAGE_REFINE_STRENGTH] if COLLAGE_REFINE else None,
+                      "styles": {cat: sorted(styles) for cat, styles in COLLAGE_PROMPTS.items()},
+                      "sources": {cat: [it.get("sha256") for it in quiz_categories.get(cat, [])[:4]]
+                                  for cat in COLLAGE_PROMPTS}}
+    quiz_collages = dict(run_stage("collages", collage_inputs,
+                                   lambda force: build_local_collages(quiz_categories, day_seed(today))) or {})
+
+# ─────────────────────────────────────────────────────────────
+# STAGE: RESPONSIVE WebP/AVIF VARIANTS for every image we ship today
+# ─────────────────────────────────────────────────────────────
+shipped = ([it for items in quiz_categories.values() for it in items] + otd_items
+           + [info for styles in quiz_collages.values() for info in styles.values()])
+variants = run_stage("variants", sorted({it.get("sha256") or it["image"] for it in shipped}),
+                     lambda force: build_variants(shipped)) or {}
+for it in shipped:
+    if it.get("sha256") in variants:
+        it["variants"] = variants[it["sha256"]]
+
+# ─────────────────────────────────────────────────────────────
+# STAGE: INLINE PLACEHOLDERS (tiny preview + dominant colour)
+# ─────────────────────────────────────────────────────────────
+placeholders = run_stage("placeholders", [PLACEHOLDER_WIDTH] + sorted({it.get("sha256") or it["image"] for it in shipped}),
+                         lambda force: build_placeholders(shipped)) or {}
+for it in shipped:
+    if it.get("sha256") in placeholders:
+        it.update(placeholders[it["sha256"]])
+
+if otd_items:
+    print(f"\n✅ Generated {len(otd_items)} On This Day images")
+    print(f"   Years: {[it['year'] for it in otd_items]}")
+    print(f"   Styles: {[it['style'] for it in otd_items]}")
 
 # ─────────────────────────────────────────────────────────────
 # WRITE quiz-data.json
@@ -812,10 +3473,22 @@ if otd_items:
         "events": otd_items,
         "distractors": otd_distractor_items
     }
-with open(JSON_PATH, "w") as f:
-    json.dump(quiz_data, f, indent=2, ensure_ascii=False)
+publish_start = time.monotonic()
+with span("publish", "stage"):
+    write_public_json(JSON_PATH, quiz_data)
+STAGE_TIMES["publish"] = round(time.monotonic() - publish_start, 3)
 
 print(f"\n✅ quiz-data.json written to {JSON_PATH}")
 print(f"   Categories: {list(quiz_categories.keys())} ({len(history_items)} history events)")
 print(f"   History styles today: {[it.get('style','?') for it in history_items]}")
 print(f"   Collages: {list(quiz_collages.keys())}")
+
+STAGE_TIMES["total"] = round(time.monotonic() - run_start, 3)
+BUILD_STATE["timings"] = STAGE_TIMES
+print(f"⏱  {', '.join(f'{k} {v:.2f}s' for k, v in STAGE_TIMES.items())}")
+write_run_metrics(today, STAGE_TIMES)
+if TRACE is not None:
+    stop_profiling(os.path.join(STATE_DIR, f"trace-{today}.json"))
+save_build_state()
+JOURNAL["complete"] = True
+save_journal()
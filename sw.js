@@ -0,0 +1,90 @@
+// Service worker for the AI News Quiz (registered from index.html).
+// Caches are versioned: bump VERSION when the app shell changes shape
+// and the old caches are dropped on activate.
+//   app shell (index.html)          stale-while-revalidate
+//   quiz-data.json                  cached copy if it is today's, else network
+//   images with ?v=<sha> / variants /
+//   archive blobs (content-named)   cache first, never stale
+//   other images                    network first, cache when offline
+//   archive JSON + day packs        stale-while-revalidate
+const VERSION = 'v1';
+const SHELL = `quiz-shell-${VERSION}`, TODAY = `quiz-today-${VERSION}`,
+      IMAGES = `quiz-images-${VERSION}`, ARCHIVE = `quiz-archive-${VERSION}`;
+const LIMITS = {[IMAGES]: 300, [ARCHIVE]: 100};   // entries per cache; oldest are evicted beyond this
+
+self.addEventListener('install', e => {
+  e.waitUntil(caches.open(SHELL).then(c => c.addAll(['./', 'index.html'])).then(() => self.skipWaiting()));
+});
+
+self.addEventListener('activate', e => {
+  const keep = [SHELL, TODAY, IMAGES, ARCHIVE];
+  e.waitUntil(caches.keys()
+    .then(keys => Promise.all(keys.filter(k => k.startsWith('quiz-') && !keep.includes(k)).map(k => caches.delete(k))))
+    .then(() => self.clients.claim()));
+});
+
+function localDate() {
+  const d = new Date();
+  return `${d.getFullYear()}-${String(d.getMonth()+1).padStart(2,'0')}-${String(d.getDate()).padStart(2,'0')}`;
+}
+
+async function put(cacheName, req, res) {
+  const cache = await caches.open(cacheName), limit = LIMITS[cacheName];
+  await cache.put(req, res);
+  if (limit) {
+    const keys = await cache.keys();   // insertion order — oldest first
+    await Promise.all(keys.slice(0, Math.max(0, keys.length - limit)).map(k => cache.delete(k)));
+  }
+}
+
+// Serve the cached copy (if `usable` accepts it) and refresh it in the background
+async function staleWhileRevalidate(e, cacheName, usable = async () => true) {
+  const hit = await caches.match(e.request, {cacheName});
+  const update = fetch(e.request).then(res => {
+    if (res.ok) e.waitUntil(put(cacheName, e.request, res.clone()));
+    return res;
+  });
+  if (hit && await usable(hit.clone())) {
+    e.waitUntil(update.catch(() => {}));
+    return hit;
+  }
+  return update.catch(err => hit || Promise.reject(err));
+}
+
+async function cacheFirst(e, cacheName) {
+  const hit = await caches.match(e.request, {cacheName});
+  if (hit) return hit;
+  const res = await fetch(e.request);
+  if (res.ok) e.waitUntil(put(cacheName, e.request, res.clone()));
+  return res;
+}
+
+async function networkFirst(e, cacheName) {
+  try {
+    const res = await fetch(e.request);
+    if (res.ok) e.waitUntil(put(cacheName, e.request, res.clone()));
+    return res;
+  } catch (err) {
+    const hit = await caches.match(e.request, {cacheName});
+    if (hit) return hit;
+    throw err;
+  }
+}
+
+self.addEventListener('fetch', e => {
+  const url = new URL(e.request.url);
+  // Range reads of packs come back as 206, which the Cache API can't store
+  if (e.request.method !== 'GET' || url.origin !== location.origin || e.request.headers.has('range')) return;
+  const path = url.pathname.slice(new URL(self.registration.scope).pathname.length);
+
+  if (path === '' || path === 'index.html') {
+    e.respondWith(staleWhileRevalidate(e, SHELL));
+  } else if (path === 'quiz-data.json') {
+    e.respondWith(staleWhileRevalidate(e, TODAY, async res => (await res.json()).date === localDate()));
+  } else if (path.startsWith('images/')) {
+    const immutable = url.searchParams.has('v') || path.startsWith('images/variants/') || path.startsWith('images/blobs/');
+    e.respondWith(immutable ? cacheFirst(e, IMAGES) : networkFirst(e, IMAGES));
+  } else if (/^quiz-data-\d{4}-\d{2}-\d{2}\.json$/.test(path) || path.startsWith('archive') || path.startsWith('packs/')) {
+    e.respondWith(staleWhileRevalidate(e, ARCHIVE));
+  }
+});